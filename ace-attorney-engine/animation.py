@@ -1,20 +1,31 @@
 
+import copy
 import random
+from collections import OrderedDict
 
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 from typing import List, Dict
 
 
 class AnimationCache:
-  def __init__(self):
+  def __init__(self, max_bytes: int = 1024 * 1024 * 1024):
     # self._cache = {}
     self._img_cache = {}
+    # prepared AnimationImage frames in least recently used order, bounded by max_bytes
+    self._anim_img_cache = OrderedDict()
+    self.max_bytes = max_bytes
+    # optional persistent store.ArrayStore of pre-scaled RGBA frames shared across runs
+    self.sprite_store = None
     # self._text_cache = {}
     self._font_cache = {}
+    self._plate_cache = {}
 
   def clear(self):
     self._img_cache.clear()
+    self._anim_img_cache.clear()
     self._font_cache.clear()
+    self._plate_cache.clear()
 
   def get_font(self, font_path, font_size, scaling_factor):
     key = hash(
@@ -75,19 +86,69 @@ class AnimationCache:
     repeat: bool = True,
     scaling_factor: int = 1.0,
   ):
-    img = self.get_image(path)
-    a = AnimationImage(
-      path,
-      img,
-      x=x, y=y, w=w, h=h,
-      key_x=key_x, key_x_reverse=key_x_reverse,
-      shake_effect=shake_effect,
-      half_speed=half_speed,
-      repeat=repeat,
-      scaling_factor=scaling_factor
+    key = (
+      path, x, y, w, h,
+      key_x,
+      key_x_reverse,
+      shake_effect,
+      half_speed,
+      repeat, scaling_factor
     )
 
-    return a
+    if key in self._anim_img_cache:
+      a = self._anim_img_cache[key]
+      self._anim_img_cache.move_to_end(key)
+    else:
+      frames, store_key = None, None
+
+      if self.sprite_store is not None:
+        store_key = self.sprite_store.file_key(path, scaling_factor, w, h, key_x, key_x_reverse)
+        arrays = self.sprite_store.get(store_key)
+
+        if arrays is not None:
+          # memory-mapped frames, no decoding or resizing needed
+          frames = [Image.fromarray(arr) for arr in arrays]
+
+      a = AnimationImage(
+        path,
+        self.get_image(path) if frames is None else None,
+        x=x, y=y, w=w, h=h,
+        key_x=key_x, key_x_reverse=key_x_reverse,
+        shake_effect=shake_effect,
+        half_speed=half_speed,
+        repeat=repeat,
+        scaling_factor=scaling_factor,
+        frames=frames
+      )
+
+      if store_key is not None and frames is None:
+        self.sprite_store.put(store_key, [np.asarray(frame) for frame in a.frames])
+
+      self._anim_img_cache[key] = a
+      self._evict()
+
+    # callers toggle effects and move layers, so they get their own view of the shared frames
+    return a.view()
+
+  def _evict(self):
+    total_bytes = sum(a.nbytes for a in self._anim_img_cache.values())
+
+    while total_bytes > self.max_bytes and len(self._anim_img_cache) > 1:
+      _, a = self._anim_img_cache.popitem(last=False)
+      total_bytes -= a.nbytes
+
+  def get_plate(self, key, layers: List, size=None):
+    if key in self._plate_cache:
+      plate = self._plate_cache[key]
+    else:
+      plate = AnimationPlate(
+        str(key),
+        layers,
+        size=size
+      )
+      self._plate_cache[key] = plate
+
+    return plate
 
 
 animation_cache = AnimationCache()
@@ -109,6 +170,7 @@ class AnimationImage:
     half_speed: bool = False,
     repeat: bool = True,
     scaling_factor: int = 1.0,
+    frames: List[Image.Image] = None,
   ):
     self.scaling_factor = scaling_factor
     self.x = int(self.scaling_factor * x)
@@ -118,7 +180,10 @@ class AnimationImage:
     self.key_x_reverse = key_x_reverse
     img = img
 
-    if img.format == "GIF" and img.is_animated:
+    if frames is not None:
+      # already prepared frames, e.g. from the sprite store
+      self.frames = list(frames)
+    elif img.format == "GIF" and img.is_animated:
       self.frames = []
       for idx in range(img.n_frames):
         img.seek(idx)
@@ -155,9 +220,28 @@ class AnimationImage:
 
     self.w = self.frames[0].size[0]
     self.h = self.frames[0].size[1]
+    # per-frame arrays filled lazily by array based compositors, by representation name,
+    # shared by all copies of this layer
+    self.arrays = [{} for _ in self.frames]
     self.shake_effect = shake_effect
     self.half_speed = half_speed
     self.repeat = repeat
+    # source of the shake jitter, replaced by a seeded random.Random for reproducible scenes
+    self.rng = random
+
+  @property
+  def nbytes(self):
+    nbytes = sum(4 * frame.size[0] * frame.size[1] for frame in self.frames)
+
+    for arrays in self.arrays:
+      for value in arrays.values():
+        nbytes += _nbytes(value)
+
+    return nbytes
+
+  def view(self):
+    # shallow copy sharing frames and arrays, with its own position and effect flags
+    return copy.copy(self)
 
   def resize(self, frame, *, w: int = None, h: int = None):
     if w is not None and h is not None:
@@ -174,7 +258,7 @@ class AnimationImage:
 
     return frame
 
-  def render(self, background: Image = None, frame: int = 0):
+  def frame_index(self, frame: int = 0):
     if frame > len(self.frames) - 1:
       if self.repeat:
         frame = frame % len(self.frames)
@@ -184,7 +268,37 @@ class AnimationImage:
     if self.half_speed and self.repeat:
       frame = int(frame / 2)
 
-    _img = self.frames[frame]
+    return frame
+
+  def offset(self):
+    offset = (self.x, self.y)
+
+    if self.shake_effect:
+      offset = (self.x + self.rng.randint(-1, 1), self.y + self.rng.randint(-1, 1))
+
+    return offset
+
+  def state(self, frame: int = 0):
+    # what the layer shows at frame, equal states render identically; a shaking layer moves
+    # at random and has no state
+    if self.shake_effect:
+      return None
+
+    return (
+      self.path, self.w, self.h,
+      self.key_x, self.key_x_reverse,
+      self.scaling_factor,
+      self.x, self.y,
+      self.frame_index(frame)
+    )
+
+  def bounds(self, frame: int = 0):
+    # rectangles (x0, y0, x1, y1) the layer covers at frame, without shake
+    w, h = self.frames[self.frame_index(frame)].size
+    return [(self.x, self.y, self.x + w, self.y + h)]
+
+  def render(self, background: Image = None, frame: int = 0):
+    _img = self.frames[self.frame_index(frame)]
 
     if background is None:
       _w, _h = _img.size
@@ -192,13 +306,7 @@ class AnimationImage:
     else:
       _background = background
 
-    bg_w, bg_h = _background.size
-    offset = (self.x, self.y)
-
-    if self.shake_effect:
-      offset = (self.x + random.randint(-1, 1), self.y + random.randint(-1, 1))
-
-    _background.paste(_img, offset, mask=_img)
+    _background.paste(_img, self.offset(), mask=_img)
 
     if background is None:
       return _background
@@ -222,6 +330,58 @@ class AnimationImage:
     )
 
 
+class AnimationPlate(AnimationImage):
+  # static layers flattened once, either as an opaque background (size is None) or as a
+  # transparent full-frame overlay of the given size
+  def __init__(self, path: str, layers: List[AnimationImage], size=None):
+    self.path = path
+    self.scaling_factor = layers[0].scaling_factor
+    self.x = 0
+    self.y = 0
+    self.key_x = None
+    self.key_x_reverse = False
+    self.opaque = size is None
+
+    if self.opaque:
+      plate = layers[0].render()
+      for layer in layers[1:]:
+        layer.render(plate)
+    else:
+      plate = Image.new("RGBA", size, (0, 0, 0, 0))
+      for layer in layers:
+        layer_img = Image.new("RGBA", size, (0, 0, 0, 0))
+        layer_img.paste(layer.frames[0], (layer.x, layer.y))
+        plate = Image.alpha_composite(plate, layer_img)
+
+    self.frames = [plate]
+    self.arrays = [{}]
+    self.w = plate.size[0]
+    self.h = plate.size[1]
+    self.shake_effect = False
+    self.half_speed = False
+    self.repeat = True
+    self.rng = random
+
+  def render(self, background: Image = None, frame: int = 0):
+    if background is None:
+      return self.frames[0].copy()
+
+    return super().render(background, frame)
+
+
+class TextLine:
+  # one line of an AnimationText rasterized once: its glyph coverage and the width of the
+  # coverage shown after each character, so typewriter frames only cut the line
+  def __init__(self, start: int, x: int, y: int, coverage: Image, widths: List[int]):
+    self.start = start
+    self.x = x
+    self.y = y
+    self.coverage = coverage
+    self.widths = widths
+    # arrays filled lazily by array based compositors, by representation name
+    self.arrays = {}
+
+
 class AnimationText:
   def __init__(
     self,
@@ -239,75 +399,248 @@ class AnimationText:
     self.typewriter_effect = typewriter_effect
     self.font = font
     self.colour = colour
+    # rasterized lines, filled on first use and shared by all copies of this text
+    self._lines = []
+
+  def release(self):
+    # drops the rasterized lines shared by this text and its copies, they are rasterized
+    # again on their next use
+    self._lines.clear()
+
+  @property
+  def ink(self):
+    return ImageColor.getrgb(self.colour or "white")[:3]
+
+  def lines(self):
+    if len(self._lines) > 0 or len(self.text) == 0:
+      return self._lines
+
+    draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+    # same line advance ImageDraw uses for multiline text with spacing=4
+    line_spacing = (
+      draw.multiline_textbbox((0, 0), "A\nA", font=self.font, spacing=4)[3]
+      - draw.textbbox((0, 0), "A", font=self.font)[3]
+    )
+    start = 0
+
+    for idx, line in enumerate(self.text.split("\n")):
+      left, top, right, bottom = draw.textbbox((0, 0), line, font=self.font)
+
+      if right > left and bottom > top:
+        coverage = Image.new("L", (right - left, bottom - top), 0)
+        # TODO play with fonts to get cripser
+        # fill = None,
+        # font = None,
+        # anchor = None,
+        # spacing = 4,
+        # align = "left",
+        # direction = None,
+        # features = None,
+        # language = None,
+        # stroke_width = 0,
+        # stroke_fill = None,
+        ImageDraw.Draw(coverage).text(
+          (-left, -top),
+          line,
+          font=self.font,
+          fill=255,
+          stroke_width=0,
+          stroke_fill=0
+        )
+        # a partly typed line is cut after the ink of its last shown character, a complete
+        # line is shown whole
+        widths = [0] + [
+          min(max(draw.textbbox((0, 0), line[:length], font=self.font)[2] - left, 0), right - left)
+          for length in range(1, len(line))
+        ] + [right - left]
+        self._lines.append(
+          TextLine(start, self.x + left, self.y + idx * line_spacing + top, coverage, widths)
+        )
+
+      start += len(line) + 1
+
+    return self._lines
+
+  def visible(self, frame: int = 0):
+    # (line, width of its coverage) for every line with shown characters
+    length = min(frame, len(self.text)) if self.typewriter_effect else len(self.text)
+
+    for line in self.lines():
+      shown = min(length - line.start, len(line.widths) - 1)
+
+      if shown > 0 and line.widths[shown] > 0:
+        yield line, line.widths[shown]
+
+  def bounds(self, frame: int = 0):
+    return [
+      (line.x, line.y, line.x + width, line.y + line.coverage.size[1])
+      for line, width in self.visible(frame)
+    ]
+
+  def changes(self, previous: 'AnimationText', previous_frame: int, frame: int):
+    # rectangles in which frame differs from previous_frame of previous, a copy of this text,
+    # the columns typed in between
+    previous_widths = {id(line): width for line, width in previous.visible(previous_frame)}
+    widths = {id(line): width for line, width in self.visible(frame)}
+    rects = []
+
+    for line in self.lines():
+      w0, w1 = previous_widths.get(id(line), 0), widths.get(id(line), 0)
+
+      if w0 != w1:
+        rects.append((line.x + min(w0, w1), line.y, line.x + max(w0, w1), line.y + line.coverage.size[1]))
+
+    return rects
 
   def render(self, background: Image, frame: int = 0):
-    draw = ImageDraw.Draw(background)
+    ink = ImageColor.getcolor(self.colour or "white", background.mode)
+
+    for line, width in self.visible(frame):
+      coverage = line.coverage
+
+      if width < coverage.size[0]:
+        coverage = coverage.crop((0, 0, width, coverage.size[1]))
+
+      # a solid fill through the coverage blends exactly like ImageDraw.text
+      background.paste(ink, (line.x, line.y), mask=coverage)
+
+    return background
+
+  def state(self, frame: int = 0):
     _text = self.text
 
     if self.typewriter_effect:
       _text = _text[:frame]
 
-    # TODO play with fonts to get cripser
-    # fill = None,
-    # font = None,
-    # anchor = None,
-    # spacing = 4,
-    # align = "left",
-    # direction = None,
-    # features = None,
-    # language = None,
-    # stroke_width = 0,
-    # stroke_fill = None,
-
-    if self.font is not None:
-      draw.text(
-        (self.x, self.y),
-        _text,
-        font=self.font,
-        fill=self.colour,
-        spacing=4,
-        stroke_width=0,
-        stroke_fill=0
-      )
-    else:
-      draw.text(
-        (self.x, self.y),
-        _text,
-        fill=self.colour,
-        spacing=4,
-        stroke_width=0,
-        stroke_fill=0
-      )
-
-    return background
+    return (
+      _text, self.x, self.y, self.colour,
+      getattr(self.font, 'path', None), getattr(self.font, 'size', None)
+    )
 
   def __str__(self):
     return self.text
 
 
 class SceneAnimation:
-  def __init__(self, arr: List, length: int, start_frame: int = 0):
-    self.frames = []
-    text_idx = 0
-    arr = list(
-      filter(lambda x: x is not None, arr)
-    )
-    #     print([str(x) for x in arr])
+  def __init__(self, arr: List, length: int, start_frame: int = 0, rng: random.Random = None):
+    # frames are composed lazily, so snapshot the layers now: the engine toggles effects
+    # such as shake_effect and typewriter_effect on shared layers between animations
+    self.layers = [
+      copy.copy(obj) for obj in arr if obj is not None
+    ]
+
+    if rng is not None:
+      for obj in self.layers:
+        if isinstance(obj, AnimationImage):
+          obj.rng = rng
+    self.length = length
+    self.start_frame = start_frame
+    # frame offsets shown by holding the previous frame longer, they are not composed
+    self.held = set()
+
+  def __len__(self):
+    return max(self.length, 0)
+
+  @property
+  def size(self):
+    if isinstance(self.layers[0], AnimationImage):
+      return self.layers[0].w, self.layers[0].h
+
+    return self.layers[0].size
+
+  def indices(self):
+    # (layer frame, text frame) for every composed frame of the animation
+    for text_idx, idx in enumerate(range(self.start_frame, self.start_frame + self.length)):
+      if text_idx not in self.held:
+        yield idx, text_idx
+
+  def state(self, idx: int, text_idx: int):
+    # the layer states of a frame, frames with equal states are identical; None when a layer
+    # has no state, e.g. while it shakes
+    state = [layer_state(obj, idx, text_idx) for obj in self.layers]
+    return None if None in state else tuple(state)
+
+  def changes(self, previous: 'SceneAnimation', previous_idx: int, previous_text_idx: int, idx: int, text_idx: int):
+    # rectangles (x0, y0, x1, y1) outside which frame idx equals frame previous_idx of previous,
+    # this or an earlier animation of the same size; None when the frame has to be composed
+    # whole, e.g. while a layer shakes or once the background changed
+    if len(previous.layers) != len(self.layers):
+      return None
+
+    width, height = self.size
+    rects = []
+
+    for layer_idx, (previous_obj, obj) in enumerate(zip(previous.layers, self.layers)):
+      previous_state = layer_state(previous_obj, previous_idx, previous_text_idx)
+      state = layer_state(obj, idx, text_idx)
+
+      if previous_state is None or state is None or (layer_idx == 0 and previous_state != state):
+        return None
+
+      if previous_state == state:
+        continue
+
+      previous_frame = previous_text_idx if isinstance(previous_obj, AnimationText) else previous_idx
+      frame = text_idx if isinstance(obj, AnimationText) else idx
+
+      if isinstance(obj, AnimationText) and isinstance(previous_obj, AnimationText) \
+        and obj.lines() is previous_obj.lines():
+        rects.extend(obj.changes(previous_obj, previous_frame, frame))
+      else:
+        rects.extend(previous_obj.bounds(previous_frame))
+        rects.extend(obj.bounds(frame))
 
-    for idx in range(start_frame, start_frame + length):
-      if isinstance(arr[0], AnimationImage):
-        background = arr[0].render()
+    clipped = []
+    for x0, y0, x1, y1 in rects:
+      rect = (max(x0, 0), max(y0, 0), min(x1, width), min(y1, height))
+
+      if rect[2] > rect[0] and rect[3] > rect[1] and rect not in clipped:
+        clipped.append(rect)
+
+    return clipped
+
+  def states(self):
+    # the state of every frame, held ones included
+    for text_idx, idx in enumerate(range(self.start_frame, self.start_frame + self.length)):
+      yield self.state(idx, text_idx)
+
+  def render(self, idx: int, text_idx: int):
+    if isinstance(self.layers[0], AnimationImage):
+      background = self.layers[0].render()
+    else:
+      background = self.layers[0]
+
+    for obj in self.layers[1:]:
+      if isinstance(obj, AnimationText):
+        obj.render(background, frame=text_idx)
       else:
-        background = arr[0]
+        obj.render(background, frame=idx)
+
+    return background
+
+  def __iter__(self):
+    return self.frames()
+
+  def frames(self):
+    for idx, text_idx in self.indices():
+      yield self.render(idx, text_idx)
+
+
+def layer_state(obj, idx: int, text_idx: int):
+  if isinstance(obj, AnimationText):
+    return obj.state(text_idx)
+
+  if isinstance(obj, AnimationImage):
+    return obj.state(idx)
+
+  return None
+
 
-      for obj in arr[1:]:
-        if isinstance(obj, AnimationText):
-          obj.render(background, frame=text_idx)
-        else:
-          obj.render(background, frame=idx)
+def _nbytes(value):
+  if isinstance(value, tuple):
+    return sum(_nbytes(v) for v in value)
 
-      self.frames.append(background)
-      text_idx += 1
+  return getattr(value, 'nbytes', 0)
 
 
 def add_margin(pil_img, top, right, bottom, left):
@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+from pydub import AudioSegment
+
+
+class AudioCache:
+  def __init__(self):
+    # decoded samples by path, mtime and output layout, kept for the whole process
+    self._sample_cache = {}
+    # optional persistent store.ArrayStore of decoded samples shared across runs
+    self.sample_store = None
+
+  def clear(self):
+    self._sample_cache.clear()
+
+  def get_samples(self, path: str, frame_rate: int = 44100, channels: int = 2, gain: float = 0.0):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, frame_rate, channels, gain)
+
+    if key in self._sample_cache:
+      return self._sample_cache[key]
+
+    samples, store_key = None, None
+
+    if self.sample_store is not None:
+      store_key = self.sample_store.file_key(path, frame_rate, channels, gain)
+      arrays = self.sample_store.get(store_key)
+
+      if arrays is not None:
+        samples = arrays[0]
+
+    if samples is None:
+      samples = load_samples(path, frame_rate, channels, gain=gain)
+
+      if store_key is not None:
+        self.sample_store.put(store_key, [samples])
+
+    self._sample_cache[key] = samples
+    return samples
+
+
+audio_cache = AudioCache()
+
+
+class AudioTimeline(object):
+  # one preallocated buffer for the whole render, clips are mixed in at sample offsets
+  # computed from their position in milliseconds, so nothing is ever concatenated
+  def __init__(self, duration: float, frame_rate: int = 44100, channels: int = 2):
+    self.frame_rate = frame_rate
+    self.channels = channels
+    # int32 so overlapping clips can be summed and clipped once, like AudioSegment.overlay
+    self.samples = np.zeros((self.offset(duration), channels), dtype=np.int32)
+
+  def __len__(self):
+    return len(self.samples)
+
+  def offset(self, position: float) -> int:
+    return int(round(position * self.frame_rate / 1000))
+
+  def add(self, samples: np.ndarray, position: float, duration: float = None):
+    start = self.offset(position)
+    length = len(samples)
+
+    if duration is not None:
+      length = min(length, self.offset(position + duration) - start)
+
+    length = min(length, len(self.samples) - start)
+
+    if length <= 0:
+      return
+
+    self.samples[start:start + length] += samples[:length]
+
+  def pcm(self, chunk_frames: int = 1 << 16):
+    # interleaved signed 16-bit samples, s16le for ffmpeg, clipped chunk by chunk so the
+    # timeline is never copied whole
+    chunk = np.empty((chunk_frames, self.channels), dtype=np.int32)
+
+    for start in range(0, len(self.samples), chunk_frames):
+      samples = self.samples[start:start + chunk_frames]
+      clipped = np.clip(samples, -32768, 32767, out=chunk[:len(samples)])
+      yield clipped.astype(np.int16)
+
+
+def load_samples(path: str, frame_rate: int = 44100, channels: int = 2, gain: float = 0.0) -> np.ndarray:
+  # decodes any format ffmpeg understands into int16 samples of shape [frames, channels]
+  segment = AudioSegment.from_file(path)
+
+  if gain != 0.0:
+    segment = segment.apply_gain(gain)
+
+  segment = segment.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(2)
+  return np.frombuffer(segment.raw_data, dtype=np.int16).reshape(-1, channels)
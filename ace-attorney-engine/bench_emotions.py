@@ -0,0 +1,57 @@
+import time
+import argparse
+
+from emotions import EmotionModel
+
+
+# emotion detection throughput of every backend, and how often its labels agree with the
+# default 'generate' method, the fp32 model decoding with generate()
+
+backends = {
+  'torch': dict(backend='torch', method='scores'),
+  'generate': dict(backend='torch', method='generate'),
+  'quantized': dict(backend='quantized', method='scores'),
+  'onnx': dict(backend='onnx', method='scores'),
+}
+
+
+def measure(model: EmotionModel, texts, repeats: int):
+  model._get_emotions(texts[:model.batch_size])
+  start_time = time.perf_counter()
+  for _ in range(repeats):
+    emotions, scores = model._get_emotions(texts)
+  elapsed = time.perf_counter() - start_time
+
+  return emotions, scores, len(texts) * repeats / elapsed
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('texts', help='text file with one comment per line')
+  parser.add_argument('--model', default='mrm8488/t5-base-finetuned-emotion')
+  parser.add_argument('--backends', default=','.join(backends))
+  parser.add_argument('--limit', type=int, default=500)
+  parser.add_argument('--repeats', type=int, default=1)
+  parser.add_argument('--cache-folder', default='./cache')
+  args = parser.parse_args()
+
+  with open(args.texts) as f:
+    texts = [line.strip() for line in f if line.strip() != ''][:args.limit]
+
+  baseline = None
+  print(f'{len(texts)} comments')
+  for name in ['generate'] + [name for name in args.backends.split(',') if name != 'generate']:
+    start_time = time.perf_counter()
+    model = EmotionModel(args.model, cache_folder=args.cache_folder, result_cache=False, **backends[name])
+    model.load()
+    load_seconds = time.perf_counter() - start_time
+    emotions, scores, throughput = measure(model, texts, args.repeats)
+
+    if baseline is None:
+      baseline = emotions
+
+    agreement = sum(a == b for a, b in zip(emotions, baseline)) / len(texts)
+    print(
+      f'{name:<10} load {load_seconds:>6.1f} s {throughput:>8.1f} comments/s '
+      f'labels agree with generate {100 * agreement:.1f}%'
+    )
@@ -0,0 +1,73 @@
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from compositor import frame_bytes
+
+
+# bytes copied per frame when handing a composed frame to the ffmpeg pipe; every step of a
+# handoff is measured on its own as the memory it allocates, numpy and bytes allocations are
+# both traced by tracemalloc, and the steps are summed
+
+handoffs = {
+  'before (np.array, slice, astype, tobytes)': [
+    lambda frame, buffer: np.array(frame),
+    lambda arr, buffer: arr[:, :, :3],
+    lambda arr, buffer: arr.astype(np.uint8),
+    lambda arr, buffer: arr.tobytes(),
+  ],
+  'pil (tobytes raw RGB)': [
+    lambda frame, buffer: frame_bytes(frame),
+  ],
+  'numpy (memoryview of frame buffer)': [
+    lambda frame, buffer: memoryview(buffer),
+  ],
+}
+
+
+def measure(steps, frame: Image.Image, buffer: np.ndarray, frames: int):
+  copied = 0
+  tracemalloc.start()
+  for _ in range(frames):
+    data = frame
+    for step in steps:
+      start, _ = tracemalloc.get_traced_memory()
+      tracemalloc.reset_peak()
+      data = step(data, buffer)
+      _, peak = tracemalloc.get_traced_memory()
+      copied += peak - start
+    del data
+  tracemalloc.stop()
+
+  start_time = time.perf_counter()
+  for _ in range(frames):
+    data = frame
+    for step in steps:
+      data = step(data, buffer)
+  elapsed = time.perf_counter() - start_time
+
+  return copied / frames, elapsed / frames
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--width', type=int, default=512)
+  parser.add_argument('--height', type=int, default=384)
+  parser.add_argument('--frames', type=int, default=100)
+  args = parser.parse_args()
+
+  rgba = np.random.randint(0, 256, (args.height, args.width, 4), dtype=np.uint8)
+  frame = Image.fromarray(rgba).copy()
+  buffer = np.ascontiguousarray(rgba[:, :, :3])
+  frame_size = args.width * args.height * 3
+
+  print(f'{args.width}x{args.height} frame, rgb24 payload {frame_size} bytes')
+  for name, steps in handoffs.items():
+    copied, seconds = measure(steps, frame, buffer, args.frames)
+    print(
+      f'{name:<45} {copied:>12,.0f} bytes copied/frame '
+      f'({copied / frame_size:.2f}x payload) {1000 * seconds:.3f} ms/frame'
+    )
@@ -0,0 +1,517 @@
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+from animation import AnimationImage, AnimationPlate, AnimationText, SceneAnimation, TextLine
+
+
+class FrameMemo(object):
+  # composed frames by the layer states they show, kept for the whole render; the least
+  # recently used frames are dropped once they take more than max_bytes
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self._frames = OrderedDict()
+
+  def get(self, key):
+    frame = self._frames.get(key)
+
+    if frame is None:
+      self.misses += 1
+      return None
+
+    self._frames.move_to_end(key)
+    self.hits += 1
+    return frame
+
+  def put(self, key, frame: bytes):
+    if len(frame) > self.max_bytes:
+      return
+
+    self._frames[key] = frame
+    self.nbytes += len(frame)
+
+    while self.nbytes > self.max_bytes:
+      _, evicted = self._frames.popitem(last=False)
+      self.nbytes -= len(evicted)
+
+  def stats(self):
+    return {
+      'memo_hits': self.hits,
+      'memo_misses': self.misses,
+    }
+
+
+class Compositor(object):
+  # composes the frames of an animation for the ffmpeg pipe. Frames whose layer state was
+  # composed before are taken from the frame memo when memo_bytes is set.
+  pix_fmt = 'rgb24'
+
+  def __init__(self, ring_size: int = 1, memo_bytes: int = 0):
+    self.ring_size = ring_size
+    self.memo = FrameMemo(memo_bytes) if memo_bytes > 0 else None
+    # (animation, idx, text_idx, frame) of the frame handed out last
+    self._previous = None
+
+  def frames(self, animation: SceneAnimation):
+    for idx, text_idx in animation.indices():
+      key = None
+
+      if self.memo is not None:
+        key = self._memo_key(animation.state(idx, text_idx))
+
+      if key is not None:
+        frame = self.memo.get(key)
+
+        if frame is not None:
+          self._previous = (animation, idx, text_idx, frame)
+          yield frame
+          continue
+
+      frame = self._compose(animation, idx, text_idx)
+
+      if key is not None:
+        # frames from the ring are overwritten later, the memo keeps its own copy
+        self.memo.put(key, bytes(frame))
+      self._previous = (animation, idx, text_idx, frame)
+      yield frame
+
+  def stats(self):
+    return self.memo.stats() if self.memo is not None else {}
+
+  def _memo_key(self, state):
+    return state
+
+  def _compose(self, animation: SceneAnimation, idx: int, text_idx: int):
+    raise NotImplementedError
+
+
+class PILCompositor(Compositor):
+  # every frame is a new bytes object, nothing is reused while the writer holds it
+  def _compose(self, animation: SceneAnimation, idx: int, text_idx: int):
+    # packed straight to rgb24 by PIL's raw encoder, without numpy copies to drop alpha
+    return frame_bytes(animation.render(idx, text_idx))
+
+
+class NumpyCompositor(Compositor):
+  # blends layers into a preallocated rgb24 buffer with the same integer arithmetic as
+  # Image.paste(img, offset, mask=img), so frames are identical to the PIL path:
+  # out = (out * (255 - a) + rgb * a) / 255, rounded the way PIL's DIV255 rounds
+  pix_fmt = 'rgb24'
+
+  def __init__(self, ring_size: int = 1, memo_bytes: int = 0):
+    # frames are composed into ring_size rgb24 buffers in turn and handed out without any copy,
+    # so a frame stays intact until ring_size - 1 further frames were composed, e.g. while it
+    # waits in a writer queue
+    super().__init__(ring_size, memo_bytes)
+    self._buffers = []
+    self._buffer_idx = 0
+    self._scratch = None
+    self._scratch_shift = None
+
+  def _compose(self, animation: SceneAnimation, idx: int, text_idx: int):
+    width, height = animation.size
+    rects = self._dirty_rects(animation, idx, text_idx)
+    buffer = self._get_buffer(width, height)
+
+    if rects is None:
+      self._compose_region(buffer, animation, idx, text_idx, 0, 0)
+    else:
+      # outside the rectangles the frame equals the previous one, which is still intact in the
+      # ring or the memo
+      np.copyto(buffer, np.frombuffer(self._previous[3], dtype=np.uint8).reshape(buffer.shape))
+      for x0, y0, x1, y1 in rects:
+        self._compose_region(buffer[y0:y1, x0:x1], animation, idx, text_idx, x0, y0)
+
+    return buffer
+
+  def _dirty_rects(self, animation: SceneAnimation, idx: int, text_idx: int):
+    # the rectangles to compose again on top of the previous frame, None to compose it whole
+    if self._previous is None:
+      return None
+
+    previous, previous_idx, previous_text_idx, _ = self._previous
+
+    if previous.size != animation.size:
+      return None
+
+    rects = animation.changes(previous, previous_idx, previous_text_idx, idx, text_idx)
+
+    if rects is None:
+      return None
+
+    width, height = animation.size
+
+    if 2 * sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in rects) > width * height:
+      # mostly changed, composing it whole is cheaper
+      return None
+
+    return rects
+
+  def _compose_region(self, buffer: np.ndarray, animation: SceneAnimation, idx: int, text_idx: int, x0: int, y0: int):
+    # composes the part of the frame at (x0, y0) of the size of buffer
+    base, layers = animation.layers[0], animation.layers[1:]
+    height, width = buffer.shape[:2]
+
+    if isinstance(base, AnimationImage):
+      self._fill(buffer, base, idx, x0, y0)
+    else:
+      buffer[:] = np.asarray(base.convert("RGB"))[y0:y0 + height, x0:x0 + width]
+
+    for obj in layers:
+      if isinstance(obj, AnimationText):
+        self._draw_text(buffer, obj, text_idx, x0, y0)
+      else:
+        self._blend_layer(buffer, obj, idx, x0, y0)
+
+  def _get_buffer(self, width: int, height: int):
+    if len(self._buffers) == 0 or self._buffers[0].shape != (height, width, 3):
+      self._buffers = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(self.ring_size)]
+      self._scratch = np.empty((height, width, 3), dtype=np.uint16)
+      self._scratch_shift = np.empty((height, width, 3), dtype=np.uint16)
+
+    self._buffer_idx = (self._buffer_idx + 1) % len(self._buffers)
+    return self._buffers[self._buffer_idx]
+
+  def _fill(self, buffer: np.ndarray, layer: AnimationImage, frame: int, x0: int = 0, y0: int = 0):
+    if isinstance(layer, AnimationPlate) and layer.opaque:
+      # frames start from a copy of an opaque plate, its rgb is used as is
+      arrays = layer.arrays[0]
+      if 'rgb' not in arrays:
+        arrays['rgb'] = (np.asarray(layer.frames[0].convert("RGB")),)
+      height, width = buffer.shape[:2]
+      buffer[:] = arrays['rgb'][0][y0:y0 + height, x0:x0 + width]
+    else:
+      buffer[:] = 255
+      self._blend_layer(buffer, layer, frame, x0, y0)
+
+  def _blend_layer(self, buffer: np.ndarray, layer: AnimationImage, frame: int, x0: int = 0, y0: int = 0):
+    index = layer.frame_index(frame)
+    x, y = layer.offset()
+    premultiplied, inverse_alpha = layer_arrays(layer, index)
+    self._blend(buffer, premultiplied, inverse_alpha, x - x0, y - y0)
+
+  def _blend(self, buffer: np.ndarray, premultiplied, inverse_alpha, x: int, y: int):
+    height, width = buffer.shape[:2]
+    l_height, l_width = premultiplied.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + l_width, width), min(y + l_height, height)
+
+    if x1 <= x0 or y1 <= y0:
+      return
+
+    out = buffer[y0:y1, x0:x1]
+    src = premultiplied[y0 - y:y1 - y, x0 - x:x1 - x]
+
+    if inverse_alpha is None:
+      # fully opaque layer, a plain copy
+      out[:] = src
+      return
+
+    inv = inverse_alpha[y0 - y:y1 - y, x0 - x:x1 - x]
+    tmp = self._scratch[:y1 - y0, :x1 - x0]
+    tmp_shift = self._scratch_shift[:y1 - y0, :x1 - x0]
+    np.multiply(out, inv, out=tmp, dtype=np.uint16)
+    tmp += src
+    tmp += 128
+    np.right_shift(tmp, 8, out=tmp_shift)
+    tmp += tmp_shift
+    tmp >>= 8
+    np.copyto(out, tmp, casting='unsafe')
+
+  def _draw_text(self, buffer: np.ndarray, text: AnimationText, frame: int, x0: int = 0, y0: int = 0):
+    # lines are rasterized once, a typewriter frame blends the typed part of each line
+    for line, width in text.visible(frame):
+      premultiplied, inverse_alpha = line_arrays(text, line)
+      self._blend(buffer, premultiplied[:, :width], inverse_alpha[:, :width], line.x - x0, line.y - y0)
+
+
+class PaletteOverflow(Exception):
+  pass
+
+
+class Palette(object):
+  # palette of up to 256 colours, indices never change once assigned so the previous frame
+  # stays valid as colours are added, until the palette is cleared
+  def __init__(self):
+    self.rgb = np.zeros((256, 3), dtype=np.uint8)
+    # ffmpeg's pal8 palette, native-endian 0xAARRGGBB entries
+    self.argb = np.zeros(256, dtype=np.uint32)
+    self._lookup = {}
+    # bumped whenever colours are dropped, which invalidates indexed layers
+    self.generation = 0
+
+  def __len__(self):
+    return len(self._lookup)
+
+  def clear(self):
+    # drops every colour, which invalidates indexed layers
+    if len(self) == 0:
+      return
+
+    self._lookup = {}
+    self.rgb[:] = 0
+    self.argb[:] = 0
+    self.generation += 1
+
+  def index(self, rgb: np.ndarray) -> np.ndarray:
+    packed = (
+      (rgb[..., 0].astype(np.uint32) << 16) | (rgb[..., 1].astype(np.uint32) << 8) | rgb[..., 2]
+    )
+    colours, inverse = np.unique(packed.ravel(), return_inverse=True)
+    lut = np.empty(len(colours), dtype=np.uint8)
+
+    for idx, colour in enumerate(colours.tolist()):
+      palette_idx = self._lookup.get(colour)
+
+      if palette_idx is None:
+        palette_idx = len(self._lookup)
+
+        if palette_idx > 255:
+          raise PaletteOverflow('more than 256 colours')
+
+        self._lookup[colour] = palette_idx
+        self.rgb[palette_idx] = ((colour >> 16) & 255, (colour >> 8) & 255, colour & 255)
+        self.argb[palette_idx] = 0xFF000000 | colour
+      lut[idx] = palette_idx
+
+    return lut[inverse].reshape(packed.shape)
+
+
+class PaletteCompositor(NumpyCompositor):
+  # composes uint8 palette indices and sends frames as pal8, the indices followed by the
+  # 1024 byte palette. Layers with binary alpha are composited through their transparency
+  # mask, layers with partial alpha and text are blended in rgb on their own region only and
+  # indexed again, so frames match the rgb compositors exactly apart from text, whose
+  # coverage is rounded to text_levels levels to keep the colours of its edges few. Every
+  # frame carries its own palette, a frame whose colours no longer fit starts a new one.
+  # Raises PaletteOverflow when a single frame needs more than 256 colours.
+  pix_fmt = 'pal8'
+  text_levels = 8
+
+  def __init__(self, ring_size: int = 1, memo_bytes: int = 0):
+    super().__init__(ring_size, memo_bytes)
+    self.palette = Palette()
+    self._previous_generation = None
+
+  def fits(self, animations: List[SceneAnimation]):
+    # whether the frames of the animations fit in 256 colours each, judged by the last frame
+    # of every animation, the one showing all of its text. Checked text is rasterized again
+    # when its frames are composed, so its rasters are not kept for the whole segment.
+    try:
+      for animation in animations:
+        if len(animation) == 0:
+          continue
+
+        self.palette.clear()
+        width, height = animation.size
+        self._get_buffer(width, height)
+        out = np.empty((height, width), dtype=np.uint8)
+        self._compose_region(out, animation, animation.start_frame + len(animation) - 1, len(animation) - 1, 0, 0)
+
+        for obj in animation.layers[1:]:
+          if isinstance(obj, AnimationText):
+            obj.release()
+    except PaletteOverflow:
+      return False
+    finally:
+      # the check composed into the ring, the next frame is composed whole on an empty palette
+      self.palette.clear()
+      self._previous = None
+
+    return True
+
+  def _memo_key(self, state):
+    # memoized frames hold indices into the palette as it was, valid until colours are dropped
+    if state is None:
+      return None
+
+    return self.palette.generation, state
+
+  def _compose(self, animation: SceneAnimation, idx: int, text_idx: int):
+    width, height = animation.size
+    size = width * height
+    rects = self._dirty_rects(animation, idx, text_idx)
+    buffer = self._get_buffer(width, height)
+    out = buffer[:size].reshape(height, width)
+
+    try:
+      self._compose_indices(buffer, out, animation, idx, text_idx, rects)
+    except PaletteOverflow:
+      # the frame is composed again, whole, on an empty palette in the same buffer; frames
+      # handed out earlier keep the palette they were sent with
+      self.palette.clear()
+      self._compose_indices(buffer, out, animation, idx, text_idx, None)
+
+    buffer[size:].view(np.uint32)[:] = self.palette.argb
+    self._previous_generation = self.palette.generation
+    return buffer
+
+  def _compose_indices(self, buffer: np.ndarray, out: np.ndarray, animation: SceneAnimation, idx: int, text_idx: int, rects):
+    if rects is None:
+      self._compose_region(out, animation, idx, text_idx, 0, 0)
+    else:
+      np.copyto(buffer, np.frombuffer(self._previous[3], dtype=np.uint8))
+      for x0, y0, x1, y1 in rects:
+        self._compose_region(out[y0:y1, x0:x1], animation, idx, text_idx, x0, y0)
+
+  def _dirty_rects(self, animation: SceneAnimation, idx: int, text_idx: int):
+    # indices of the previous frame are only reused while its colours are in the palette
+    if self._previous_generation != self.palette.generation:
+      return None
+
+    return super()._dirty_rects(animation, idx, text_idx)
+
+  def _compose_region(self, out: np.ndarray, animation: SceneAnimation, idx: int, text_idx: int, x0: int, y0: int):
+    base, layers = animation.layers[0], animation.layers[1:]
+    height, width = out.shape
+
+    if isinstance(base, AnimationImage):
+      self._fill_indexed(out, base, idx, x0, y0)
+    else:
+      out[:] = self.palette.index(np.asarray(base.convert("RGB"))[y0:y0 + height, x0:x0 + width])
+
+    for obj in layers:
+      if isinstance(obj, AnimationText):
+        self._draw_text_indexed(out, obj, text_idx, x0, y0)
+      else:
+        self._blend_indexed(out, obj, idx, x0, y0)
+
+  def _get_buffer(self, width: int, height: int):
+    size = width * height + 4 * 256
+
+    if len(self._buffers) == 0 or self._buffers[0].shape != (size,):
+      self._buffers = [np.empty(size, dtype=np.uint8) for _ in range(self.ring_size)]
+      self._scratch = np.empty((height, width, 3), dtype=np.uint16)
+      self._scratch_shift = np.empty((height, width, 3), dtype=np.uint16)
+
+    self._buffer_idx = (self._buffer_idx + 1) % len(self._buffers)
+    return self._buffers[self._buffer_idx]
+
+  def _indexed(self, layer: AnimationImage, index: int):
+    # (indices, opaque mask) of a frame, mask is None for an opaque plate, and the whole entry
+    # is None when the frame has partial alpha and has to be blended in rgb
+    arrays = layer.arrays[index]
+    entry = arrays.get('indexed')
+
+    if entry is None or entry[0] is not self.palette or entry[1] != self.palette.generation:
+      frame = np.asarray(layer.frames[index].convert("RGBA"))
+      alpha = frame[:, :, 3]
+
+      if isinstance(layer, AnimationPlate) and layer.opaque:
+        indexed = (self.palette.index(frame[:, :, :3]), None)
+      elif np.all((alpha == 0) | (alpha == 255)):
+        mask = alpha == 255
+        indices = np.zeros(alpha.shape, dtype=np.uint8)
+        indices[mask] = self.palette.index(frame[:, :, :3][mask])
+        indexed = (indices, mask)
+      else:
+        indexed = None
+
+      entry = (self.palette, self.palette.generation, indexed)
+      arrays['indexed'] = entry
+
+    return entry[2]
+
+  def _fill_indexed(self, out: np.ndarray, layer: AnimationImage, frame: int, x0: int = 0, y0: int = 0):
+    if isinstance(layer, AnimationPlate) and layer.opaque:
+      height, width = out.shape
+      out[:] = self._indexed(layer, 0)[0][y0:y0 + height, x0:x0 + width]
+    else:
+      out[:] = self.palette.index(np.array([255, 255, 255], dtype=np.uint8))
+      self._blend_indexed(out, layer, frame, x0, y0)
+
+  def _blend_indexed(self, out: np.ndarray, layer: AnimationImage, frame: int, ox: int = 0, oy: int = 0):
+    index = layer.frame_index(frame)
+    x, y = layer.offset()
+    x, y = x - ox, y - oy
+    height, width = out.shape
+    l_width, l_height = layer.frames[index].size
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + l_width, width), min(y + l_height, height)
+
+    if x1 <= x0 or y1 <= y0:
+      return
+
+    region = out[y0:y1, x0:x1]
+    indexed = self._indexed(layer, index)
+
+    if indexed is not None:
+      indices, mask = indexed
+      np.copyto(
+        region,
+        indices[y0 - y:y1 - y, x0 - x:x1 - x],
+        where=mask[y0 - y:y1 - y, x0 - x:x1 - x]
+      )
+    else:
+      premultiplied, inverse_alpha = layer_arrays(layer, index)
+      rgb = self.palette.rgb[region]
+      self._blend(rgb, premultiplied, inverse_alpha, x - x0, y - y0)
+      region[:] = self.palette.index(rgb)
+
+  def _draw_text_indexed(self, out: np.ndarray, text: AnimationText, frame: int, ox: int = 0, oy: int = 0):
+    height, width = out.shape
+
+    for line, line_width in text.visible(frame):
+      premultiplied, inverse_alpha = line_arrays(text, line, levels=self.text_levels)
+      x, y = line.x - ox, line.y - oy
+      x0, y0 = max(x, 0), max(y, 0)
+      x1, y1 = min(x + line_width, width), min(y + premultiplied.shape[0], height)
+
+      if x1 <= x0 or y1 <= y0:
+        continue
+
+      region = out[y0:y1, x0:x1]
+      rgb = self.palette.rgb[region]
+      self._blend(rgb, premultiplied[:, :line_width], inverse_alpha[:, :line_width], x - x0, y - y0)
+      region[:] = self.palette.index(rgb)
+
+
+def frame_bytes(frame: Image.Image) -> bytes:
+  return frame.tobytes("raw", "RGB")
+
+
+def layer_arrays(layer: AnimationImage, index: int):
+  # (rgb * alpha as uint16, 255 - alpha as uint8), or (rgb, None) when the frame is opaque
+  arrays = layer.arrays[index]
+
+  if 'premultiplied' not in arrays:
+    frame = np.asarray(layer.frames[index].convert("RGBA"))
+    alpha = frame[:, :, 3:]
+
+    if alpha.min() == 255:
+      arrays['premultiplied'] = (np.ascontiguousarray(frame[:, :, :3]), None)
+    else:
+      premultiplied = frame[:, :, :3].astype(np.uint16) * alpha
+      arrays['premultiplied'] = (premultiplied, 255 - alpha)
+
+  return arrays['premultiplied']
+
+
+def line_arrays(text: AnimationText, line: TextLine, levels: int = 256):
+  # (ink * coverage as uint16, 255 - coverage as uint8) of a rasterized text line, with the
+  # coverage rounded to the given number of evenly spaced levels
+  name = 'premultiplied' if levels >= 256 else f'premultiplied-{levels}'
+
+  if name not in line.arrays:
+    coverage = np.asarray(line.coverage)[:, :, None]
+
+    if levels < 256:
+      step = 255 / (levels - 1)
+      coverage = np.round(np.round(coverage / step) * step).astype(np.uint8)
+
+    ink = np.array(text.ink, dtype=np.uint16)
+    line.arrays[name] = (coverage * ink, 255 - coverage)
+
+  return line.arrays[name]
+
+
+compositors = {
+  'pil': PILCompositor,
+  'numpy': NumpyCompositor,
+  'palette': PaletteCompositor,
+}
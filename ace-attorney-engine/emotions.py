@@ -1,33 +1,117 @@
+import os
+import hashlib
+import warnings
+import unicodedata
 from typing import List, Tuple
 
 from tqdm import tqdm
 import torch
-from torch.utils.data import DataLoader, Dataset
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+import transformers
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM
 
 from comments import Comment, EmotionComment
+from script_constants import emotion_labels
+from store import KeyValueStore
 
 
 class EmotionModel(object):
-  def __init__(self, model_name, batch_size=8, max_seq_len=512, num_workers=4, force_max_seq_len=False):
+  def __init__(
+    self,
+    model_name,
+    batch_size=64,
+    max_seq_len=512,
+    num_threads=None,
+    num_interop_threads=None,
+    force_max_seq_len=False,
+    max_batch_tokens=None,
+    method='generate',
+    labels=emotion_labels,
+    backend='torch',
+    cache_folder='./cache',
+    result_cache=True
+  ):
     self.model_name = model_name
-    self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-    self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
-    self.model.eval()
+    # 'torch' runs the fp32 model, 'quantized' the model with int8 dynamically quantized linear
+    # layers and 'onnx' the scores method exported to ONNX and run with onnxruntime; exported
+    # and quantized models are kept under cache_folder
+    self.backend = backend
+    self.cache_folder = cache_folder
+    if self.backend == 'onnx' and method != 'scores':
+      raise ValueError(f'the onnx backend only supports the scores method, not {method}')
     self.norm = torch.nn.Softmax(dim=-1)
+    # most comments per batch, batches are also bounded by max_batch_tokens padded tokens,
+    # by default derived from the memory available when emotions are detected
     self.batch_size = batch_size
+    self.max_batch_tokens = max_batch_tokens
     self.max_seq_len = max_seq_len
     self.force_max_seq_len = force_max_seq_len
-    self.num_workers = num_workers
+    # torch (or onnxruntime) intra-op and inter-op threads, None keeps the library defaults;
+    # set them when several renders share a machine
+    self.num_threads = num_threads
+    self.num_interop_threads = num_interop_threads
+    # 'generate' decodes with generate() and scores over the whole vocabulary, 'scores' reads
+    # the label logits of one decoder step and scores over the labels only
+    self.method = method
+    self.label_names = labels
+    # (emotion, score) of every comment text already classified, kept across runs
+    self.results = KeyValueStore(os.path.join(cache_folder, 'results.sqlite')) if result_cache else None
+    # the config is loaded for the model revision, the tokenizer and model on the first
+    # comment missing from the results
+    self.config = None
+    self.tokenizer = None
+    self.label_token_ids = None
+    self.labels = None
+    self.collator = None
+    self.model = None
+    self.scorer = None
+    self.session = None
+
+  @property
+  def results_namespace(self):
+    # scores differ between methods and model revisions, labels barely between backends
+    return f'emotions:{self.model_name}@{self.revision}:{self.method}:{self.backend}'
+
+  @property
+  def revision(self):
+    # the commit of the model on the hub, read from its config without loading the weights;
+    # models from a local folder have no revision
+    if self.config is None:
+      self.config = AutoConfig.from_pretrained(self.model_name)
+
+    return (getattr(self.config, '_commit_hash', None) or 'local')[:12]
+
+  def load(self):
+    if self.tokenizer is not None:
+      return
+
+    self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+    # first token of every label, the model answers with the label as its first token
+    self.label_token_ids = [
+      self.tokenizer(label, add_special_tokens=False)['input_ids'][0] for label in self.label_names
+    ]
+    self.labels = self.tokenizer.batch_decode([[token_id] for token_id in self.label_token_ids], skip_special_tokens=True)
     self.collator = BatchCollator(
       self.tokenizer,
       max_seq_len=self.max_seq_len,
       force_max_seq_len=self.force_max_seq_len
     )
+    self._set_threads()
+    self._load_model()
+
+  def _set_threads(self):
+    if self.num_threads is not None:
+      torch.set_num_threads(self.num_threads)
+
+    if self.num_interop_threads is not None:
+      try:
+        torch.set_num_interop_threads(self.num_interop_threads)
+      except RuntimeError as e:
+        # only possible before torch ran any parallel work in this process
+        warnings.warn(f'could not set {self.num_interop_threads} inter-op threads: {e}')
 
   def detect_emotions(self, comments: List[Comment]) -> List[EmotionComment]:
     texts = [c.body for c in comments]
-    emotions, scores = self._get_emotions(texts)
+    emotions, scores = self._get_cached_emotions(texts)
     emotion_comments = []
     for comment, emotion, score in zip(comments, emotions, scores):
       emotion_comment = EmotionComment(
@@ -39,36 +123,232 @@ class EmotionModel(object):
       emotion_comments.append(emotion_comment)
     return emotion_comments
 
+  def _get_cached_emotions(self, texts: List[str]) -> Tuple[List[str], List[float]]:
+    if self.results is None:
+      return self._get_emotions(texts)
+
+    keys = [text_key(text) for text in texts]
+    results = self.results.get_many(self.results_namespace, keys)
+    # every distinct text missing from the results is classified once
+    missing = {}
+    for key, text in zip(keys, texts):
+      if key not in results:
+        missing.setdefault(key, text)
+
+    if len(missing) > 0:
+      emotions, scores = self._get_emotions(list(missing.values()))
+      new_results = {key: [emotion, score] for key, emotion, score in zip(missing, emotions, scores)}
+      self.results.put_many(self.results_namespace, new_results)
+      results.update(new_results)
+
+    return [results[key][0] for key in keys], [results[key][1] for key in keys]
+
   def _get_emotions(self, texts: List[str]) -> Tuple[List[str], List[float]]:
-    dataset = CommentDataset(texts)
-    data_loader = DataLoader(
-      dataset,
-      batch_size=self.batch_size,
-      shuffle=False,
-      num_workers=self.num_workers,
-      collate_fn=self.collator,
-      drop_last=False
+    self.load()
+    # tokenized once up front, so comments of similar length can be batched together
+    encodings = self.tokenizer(
+      [text + '</s>' for text in texts],
+      add_special_tokens=True,
+      truncation=True,
+      max_length=self.max_seq_len
+    )['input_ids']
+    sampler = TokenBudgetSampler(
+      [len(encoding) for encoding in encodings],
+      max_batch_size=self.batch_size,
+      max_batch_tokens=self.max_batch_tokens or default_batch_tokens(),
+      max_seq_len=self.max_seq_len if self.force_max_seq_len else None
     )
-    emotions = []
-    scores = []
+    emotions = [None] * len(texts)
+    scores = [None] * len(texts)
     with torch.no_grad():
-      for batch in tqdm(data_loader, total=len(data_loader), desc='running emotion detection:'):
-        output = self.model.generate(
-          input_ids=batch['input_ids'],
-          attention_mask=batch['attention_mask'],
-          max_length=2,
-          output_scores=True,
-          return_dict_in_generate=True
-        )
-        # [bsize]
-        b_emotions = self.tokenizer.batch_decode(output.sequences[:, -1:], skip_special_tokens=True)
-        # [bsize]
-        b_scores = self.norm(output.scores[0]).max(dim=-1)[0].tolist()
-        b_scores = [float(score) for score in b_scores]
-        emotions.extend(b_emotions)
-        scores.extend(b_scores)
+      for batch_indices in tqdm(sampler, total=len(sampler), desc='running emotion detection:'):
+        # batches are padded in process, the texts were already tokenized in one call above
+        batch = self.collator([(idx, encodings[idx]) for idx in batch_indices])
+        if self.method == 'generate':
+          b_emotions, b_scores = self._generate_batch(batch)
+        else:
+          b_emotions, b_scores = self._score_batch(batch)
+        # batches are sorted by length, results go back to the position of their comment
+        for idx, emotion, score in zip(batch['indices'], b_emotions, b_scores):
+          emotions[idx] = emotion
+          scores[idx] = score
     return emotions, scores
 
+  def _generate_batch(self, batch):
+    output = self.model.generate(
+      input_ids=batch['input_ids'],
+      attention_mask=batch['attention_mask'],
+      max_length=2,
+      output_scores=True,
+      return_dict_in_generate=True
+    )
+    # [bsize]
+    b_emotions = self.tokenizer.batch_decode(output.sequences[:, -1:], skip_special_tokens=True)
+    # [bsize]
+    b_scores = self.norm(output.scores[0]).max(dim=-1)[0].tolist()
+    b_scores = [float(score) for score in b_scores]
+    return b_emotions, b_scores
+
+  def _score_batch(self, batch):
+    if self.session is not None:
+      label_scores = torch.from_numpy(self.session.run(None, {
+        'input_ids': batch['input_ids'].numpy(),
+        'attention_mask': batch['attention_mask'].numpy(),
+      })[0])
+    else:
+      label_scores = self.scorer(batch['input_ids'], batch['attention_mask'])
+    # [bsize]
+    b_scores, b_labels = label_scores.max(dim=-1)
+    b_emotions = [self.labels[label] for label in b_labels.tolist()]
+    b_scores = [float(score) for score in b_scores.tolist()]
+    return b_emotions, b_scores
+
+  def _artifact_path(self, suffix):
+    name = self.model_name.strip('/').replace('/', '--')
+    return os.path.join(self.cache_folder, 'emotions', f'{name}-{suffix}')
+
+  def _artifact_version(self):
+    # exported and quantized models are built again for another model revision, torch or
+    # transformers
+    return f'{self.revision}-torch{torch.__version__}-transformers{transformers.__version__}'
+
+  def _load_model(self):
+    if self.backend == 'onnx':
+      # imported here, onnxruntime is only needed for this backend
+      import onnxruntime
+
+      labels_key = hashlib.sha1(repr(self.label_token_ids).encode('utf-8')).hexdigest()[:8]
+      onnx_path = self._artifact_path(f'scores-{labels_key}-{self._artifact_version()}.onnx')
+      if not os.path.exists(onnx_path):
+        self._export_onnx(onnx_path)
+      options = onnxruntime.SessionOptions()
+      if self.num_threads is not None:
+        options.intra_op_num_threads = self.num_threads
+      if self.num_interop_threads is not None:
+        options.inter_op_num_threads = self.num_interop_threads
+      self.session = onnxruntime.InferenceSession(
+        onnx_path, sess_options=options, providers=['CPUExecutionProvider']
+      )
+      return
+
+    if self.backend == 'quantized':
+      # the quantized weights are kept, later runs quantize a model built from its config and
+      # load them instead of the fp32 weights
+      model_path = self._artifact_path(f'int8-{self._artifact_version()}.pt')
+      if os.path.exists(model_path):
+        model = AutoModelForSeq2SeqLM.from_config(self.config)
+        model.eval()
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        model.load_state_dict(torch.load(model_path, weights_only=True))
+      else:
+        model = AutoModelForSeq2SeqLM.from_pretrained(self.model_name, config=self.config)
+        model.eval()
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+        torch.save(model.state_dict(), model_path + '.tmp')
+        os.replace(model_path + '.tmp', model_path)
+    elif self.backend == 'torch':
+      model = AutoModelForSeq2SeqLM.from_pretrained(self.model_name)
+      model.eval()
+    else:
+      raise ValueError(f'unknown emotion backend {self.backend}')
+
+    self.model = model
+    self.scorer = LabelScorer(model, self.label_token_ids)
+
+  def _export_onnx(self, onnx_path):
+    model = AutoModelForSeq2SeqLM.from_pretrained(self.model_name)
+    model.eval()
+    scorer = LabelScorer(model, self.label_token_ids)
+    example = self.collator([(0, self.tokenizer('an example</s>')['input_ids'])])
+    os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+    with torch.no_grad():
+      torch.onnx.export(
+        scorer,
+        (example['input_ids'], example['attention_mask']),
+        onnx_path + '.tmp',
+        input_names=['input_ids', 'attention_mask'],
+        output_names=['label_scores'],
+        dynamic_axes={
+          'input_ids': {0: 'batch', 1: 'sequence'},
+          'attention_mask': {0: 'batch', 1: 'sequence'},
+          'label_scores': {0: 'batch'},
+        },
+        opset_version=14
+      )
+    os.replace(onnx_path + '.tmp', onnx_path)
+
+
+class LabelScorer(torch.nn.Module):
+  # the scores method as one module: an encoder pass and one decoder step from the start
+  # token, the same first step greedy generate() takes, with the softmax over the label
+  # tokens only
+  def __init__(self, model, label_token_ids: List[int]):
+    super().__init__()
+    self.model = model
+    self.decoder_start_token_id = model.config.decoder_start_token_id
+    self.register_buffer('label_token_ids', torch.tensor(label_token_ids, dtype=torch.long))
+
+  def forward(self, input_ids, attention_mask):
+    # built from input_ids so the batch size stays dynamic in the exported graph
+    decoder_input_ids = torch.zeros_like(input_ids[:, :1]) + self.decoder_start_token_id
+    logits = self.model(
+      input_ids=input_ids,
+      attention_mask=attention_mask,
+      decoder_input_ids=decoder_input_ids,
+      use_cache=False
+    ).logits[:, -1, :]
+    # [bsize, labels]
+    return torch.softmax(logits.index_select(-1, self.label_token_ids), dim=-1)
+
+
+def text_key(text: str) -> str:
+  # the tokenizer applies NFKC and collapses whitespace, texts differing only in those map
+  # to the same inputs and share a result
+  normalized = ' '.join(unicodedata.normalize('NFKC', text).split())
+  return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def default_batch_tokens(bytes_per_token=256 * 1024, min_tokens=512, max_tokens=32768):
+  # padded tokens per batch from a quarter of the memory available now, activations of a
+  # t5-base forward pass take roughly bytes_per_token per token
+  try:
+    available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+  except (ValueError, OSError, AttributeError):
+    return 4096
+
+  return min(max(available // 4 // bytes_per_token, min_tokens), max_tokens)
+
+
+class TokenBudgetSampler(object):
+  # batches of comment indices sorted by token length, each batch holds at most
+  # max_batch_size comments and max_batch_tokens tokens once padded to its longest comment
+  def __init__(self, lengths: List[int], max_batch_size: int, max_batch_tokens: int, max_seq_len: int = None):
+    self.batches = []
+    batch = []
+    batch_len = 0
+
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+      # comments are padded to max_seq_len when it is set, otherwise to the longest one
+      padded_len = max_seq_len or max(batch_len, lengths[idx])
+
+      if len(batch) > 0 and (len(batch) >= max_batch_size or (len(batch) + 1) * padded_len > max_batch_tokens):
+        self.batches.append(batch)
+        batch = []
+        padded_len = max_seq_len or lengths[idx]
+
+      batch.append(idx)
+      batch_len = padded_len
+
+    if len(batch) > 0:
+      self.batches.append(batch)
+
+  def __len__(self):
+    return len(self.batches)
+
+  def __iter__(self):
+    return iter(self.batches)
+
 
 class BatchCollator(object):
   def __init__(self, tokenizer, max_seq_len: int, force_max_seq_len: bool):
@@ -78,39 +358,20 @@ class BatchCollator(object):
     self.force_max_seq_len = force_max_seq_len
 
   def __call__(self, examples):
-    # creates text examples
-    texts = []
-    for text in examples:
-      texts.append(text + '</s>')
+    # examples are (index, input ids) of comments tokenized with a trailing '</s>'
     # "input_ids": batch["input_ids"].to(device),
     # "attention_mask": batch["attention_mask"].to(device),
-    tokenizer_batch = self.tokenizer.batch_encode_plus(
-      batch_text_or_text_pairs=texts,
-      add_special_tokens=True,
+    tokenizer_batch = self.tokenizer.pad(
+      {'input_ids': [input_ids for _, input_ids in examples]},
       padding='max_length' if self.force_max_seq_len else 'longest',
-      return_tensors='pt',
-      truncation=True,
-      max_length=self.max_seq_len
+      max_length=self.max_seq_len,
+      return_attention_mask=True,
+      return_tensors='pt'
     )
     batch = {
+      'indices': [idx for idx, _ in examples],
       'input_ids': tokenizer_batch['input_ids'],
       'attention_mask': tokenizer_batch['attention_mask'],
     }
 
     return batch
-
-
-class CommentDataset(Dataset):
-  def __init__(self, examples):
-    self.examples = examples
-
-  def __len__(self):
-    return len(self.examples)
-
-  def __getitem__(self, idx):
-    if torch.is_tensor(idx):
-      idx = idx.tolist()
-
-    ex = self.examples[idx]
-
-    return ex
@@ -1,17 +1,26 @@
 
 import os
+import json
 import random
+import hashlib
+import tempfile
+import threading
 import spacy
 import string
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from textwrap import wrap
 from typing import List, Dict
 
 import ffmpeg
-from pydub import AudioSegment
 from tqdm import tqdm
 import numpy as np
 
 from animation import animation_cache, SceneAnimation
+from compositor import compositors, PaletteOverflow
+from audio import audio_cache, AudioTimeline
+from writer import FrameWriter
+from store import ArrayStore, KeyValueStore
 
 from script_constants import Location, Character, Action, location_map, character_map, character_location_map, \
   audio_emotions, character_emotions, objection_emotions, shake_emotions, hold_it_emotions
@@ -22,12 +31,26 @@ from comments import Comment, EmotionComment, Author
 
 
 class PhoenixEngine(object):
+  # every held run adds a term to the setpts expression of its segment, past this many the
+  # frames of a run are written like any other to keep the ffmpeg command line short
+  max_held_runs = 1000
+  # part of every scene cache key, bump it whenever a change alters rendered frames so
+  # segments encoded by older code are not reused
+  render_version = 2
+
   def __init__(
     self,
     theme='classic',
     emotion_model='mrm8488/t5-base-finetuned-emotion',
     sentence_model='en_core_web_sm',
     emotion_threshold=0.5,
+    emotion_method='generate',
+    emotion_backend='torch',
+    emotion_cache=True,
+    emotion_threads=None,
+    emotion_interop_threads=None,
+    sentence_cache=True,
+    sentence_processes=1,
     music_min_scene_duration=4,
     fps=18,
     video_codec='libx264',
@@ -36,6 +59,19 @@ class PhoenixEngine(object):
     lag_frames=25,
     default_animation_length=11,
     scaling_factor=2.0,
+    upscale_filter=None,
+    compositor='pil',
+    writer_queue_frames=32,
+    image_cache_mb=1024,
+    frame_memo_mb=256,
+    sprite_store=True,
+    audio_store=True,
+    render_processes=1,
+    scenes_per_segment=None,
+    scene_cache=False,
+    scene_cache_mb=2048,
+    seed=0,
+    hold_frames=True,
     assets_folder='./assets',
     cache_folder='./cache',
   ):
@@ -43,6 +79,22 @@ class PhoenixEngine(object):
     self.emotion_model = emotion_model
     self.sentence_model = sentence_model
     self.emotion_threshold = emotion_threshold
+    # 'generate' classifies with generate(), 'scores' with one decoder step over the label tokens.
+    # emotion_threshold is tuned for the generate scores, scores is opt-in until its labels are
+    # measured to agree (bench_emotions.py)
+    self.emotion_method = emotion_method
+    # 'torch', 'quantized' for int8 linear layers or 'onnx' for onnxruntime
+    self.emotion_backend = emotion_backend
+    # emotions of comment texts are kept under the cache folder, the model is only loaded
+    # when a comment is missing
+    self.emotion_cache = emotion_cache
+    # cpu threads of the emotion model, None keeps torch's defaults
+    self.emotion_threads = emotion_threads
+    self.emotion_interop_threads = emotion_interop_threads
+    # sentences of comment texts are kept under the cache folder, spaCy is only loaded when
+    # a comment is missing, and splits the missing ones in sentence_processes processes
+    self.sentence_cache = sentence_cache
+    self.sentence_processes = sentence_processes
     self.music_min_scene_duration = music_min_scene_duration
     self.fps = fps
     self.video_codec = video_codec
@@ -51,17 +103,89 @@ class PhoenixEngine(object):
     self.lag_frames = lag_frames
     self.default_animation_length = default_animation_length
     self.scaling_factor = scaling_factor
+    # None composes at scaling_factor, otherwise frames are composed at native sprite resolution
+    # and ffmpeg upscales them with 'xbr' (integer factors 2-4) or a scale filter such as 'neighbor'
+    self.upscale_filter = upscale_filter
+    if self.upscale_filter == 'xbr' and self.scaling_factor not in (2, 3, 4):
+      raise ValueError(f'xbr upscaling needs a scaling factor of 2, 3 or 4, not {self.scaling_factor}')
+    # 'pil' or 'numpy', both produce identical frames, or 'palette' for pal8 frames whose text
+    # edges are rounded to a few coverage levels; segments needing more colours fall back to rgb
+    self.compositor = compositor
+    # frames waiting for the ffmpeg writer thread, the compositor ring buffers are sized from it
+    if writer_queue_frames < 1:
+      raise ValueError(f'writer_queue_frames must be at least 1, not {writer_queue_frames}')
+    self.writer_queue_frames = writer_queue_frames
+    # composed frames kept by layer state, repeated states are not composed again
+    self.frame_memo_mb = frame_memo_mb
+    self.frame_compositor = self._make_compositor(compositor)
+    self.image_cache_mb = image_cache_mb
+    # pre-scaled sprite frames persisted under the cache folder, reused by later renders
+    self.sprite_store = sprite_store
+    # decoded audio samples persisted under the cache folder
+    self.audio_store = audio_store
+    # scenes are rendered in groups of scenes_per_segment by render_processes worker processes
+    self.render_processes = render_processes
+    # cached segments are keyed by their scenes, so with the scene cache every scene is its own
+    # segment and inserting or removing a comment leaves the other cache entries valid
+    if scenes_per_segment is None:
+      scenes_per_segment = 1 if scene_cache else 4
+    self.scenes_per_segment = scenes_per_segment
+    # encoded segments are cached by a hash of their scenes, assets and render settings. Every
+    # cached scene is encoded on its own, so the cache pays off when scripts are re-rendered
+    # with small edits; least recently used entries are removed past scene_cache_mb
+    self.scene_cache = scene_cache
+    self.scene_cache_mb = scene_cache_mb
+    # sprite choices and shake jitter are drawn from per-scene generators seeded from this
+    self.seed = seed
+    # runs of identical frames are composed and piped once and duplicated by ffmpeg
+    self.hold_frames = hold_frames
     self.assets_folder = os.path.join(assets_folder, self.theme)
     self.cache_folder = cache_folder
+    self._configure_caches()
     # mrm8488/t5-base-finetuned-emotion
     self.emo = EmotionModel(
-      self.emotion_model
+      self.emotion_model,
+      method=self.emotion_method,
+      backend=self.emotion_backend,
+      cache_folder=self.cache_folder,
+      result_cache=self.emotion_cache,
+      num_threads=self.emotion_threads,
+      num_interop_threads=self.emotion_interop_threads
     )
 
-    # en_core_web_sm
-    self.nlp = spacy.load(
-      sentence_model
-    )
+    # en_core_web_sm, loaded by _load_nlp
+    self.nlp = None
+    self.sentence_store = None
+    if self.sentence_cache:
+      self.sentence_store = KeyValueStore(os.path.join(self.cache_folder, 'results.sqlite'))
+
+  @property
+  def render_scaling_factor(self):
+    # scaling applied while composing, the rest is left to ffmpeg
+    if self.upscale_filter is not None:
+      return 1.0
+
+    return self.scaling_factor
+
+  def __getstate__(self):
+    # render workers only need the render settings, not the emotion and sentence models
+    state = self.__dict__.copy()
+    state['emo'] = None
+    state['nlp'] = None
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._configure_caches()
+
+  def _configure_caches(self):
+    animation_cache.max_bytes = int(self.image_cache_mb * 1024 * 1024)
+
+    if self.sprite_store:
+      animation_cache.sprite_store = ArrayStore(os.path.join(self.cache_folder, 'sprites'))
+
+    if self.audio_store:
+      audio_cache.sample_store = ArrayStore(os.path.join(self.cache_folder, 'audio'))
 
   def animate(
     self,
@@ -77,41 +201,79 @@ class PhoenixEngine(object):
     if not os.path.exists(self.cache_folder):
       os.mkdir(self.cache_folder)
 
-    sound_effects, video_path = self._render_video(
-      scene_config
+    # the sound effects follow from the scenes alone, so the audio is mixed first and encoded
+    # by its own ffmpeg process while the video renders
+    timeline = self._render_audio(
+      self._sound_effects(scene_config)
     )
+    audio_path = os.path.join(self.cache_folder, 'audio.mka')
+    audio_process, audio_thread = self._encode_audio(timeline, audio_path)
 
-    audio_path = self._render_audio(
-      sound_effects
+    video_path = self._render_video(
+      scene_config
     )
 
-    video_input = ffmpeg.input(video_path)
-    audio_input = ffmpeg.input(audio_path)
+    audio_thread.join()
+    if audio_process.wait() != 0:
+      raise RuntimeError(f'ffmpeg could not encode the audio to {audio_path}')
 
-    process = (
+    # both streams were already encoded, muxing only copies them so every frame and sample
+    # is encoded exactly once
+    (
       ffmpeg.output(
-        video_input,
-        audio_input,
+        ffmpeg.input(video_path),
+        ffmpeg.input(audio_path),
         output_filename,
-        pix_fmt='yuv420p',
-        vcodec=self.video_codec,
-        r=self.fps,
-        acodec=self.audio_codec,
-        crf=self.video_crf
+        vcodec='copy',
+        acodec='copy'
       )
         .overwrite_output()
+        .run(quiet=True)
+    )
+
+  def _sound_effects(self, scene_configs):
+    # scenes are processed again when rendered, their animations are dropped here before any
+    # text is rasterized
+    return [obj for scene_config in scene_configs for obj in self._process_scene(scene_config)[1]]
+
+  def _encode_audio(self, timeline: AudioTimeline, audio_path: str):
+    # mixed samples are piped as raw pcm and encoded once with audio_codec, from a thread so
+    # the encode overlaps with rendering the video
+    process = (
+      ffmpeg.input(
+        'pipe:',
+        format='s16le',
+        ar=timeline.frame_rate,
+        ac=timeline.channels
+      )
+        .output(audio_path, acodec=self.audio_codec)
+        .overwrite_output()
+        .global_args('-loglevel', 'error')
         .run_async(pipe_stdin=True)
     )
-    process.wait()
+
+    def write():
+      try:
+        for chunk in timeline.pcm():
+          process.stdin.write(memoryview(chunk))
+      except BrokenPipeError:
+        # ffmpeg exited early, its exit status reports the failure
+        pass
+      finally:
+        process.stdin.close()
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    return process, thread
 
   def _configure_scene(self, comments: List[EmotionComment]):
     # 30 chars per line, 3 lines, but we must subtract 3 for the final potential "..."
     wrap_threshold = (3 * 30) - 3
     scene = []
 
-    for comment in comments:
-      tokens = self.nlp(comment.body)
-      sentences = [sent.string.strip() for sent in tokens.sents]
+    comment_sentences = self._split_sentences([comment.body for comment in comments])
+
+    for comment, sentences in zip(comments, comment_sentences):
       joined_sentences, current_sentence = [], None
 
       for sentence in sentences:
@@ -146,7 +308,8 @@ class PhoenixEngine(object):
       if emotion is None or emotion_score <= self.emotion_threshold:
         emotion = 'normal'
 
-      character_emotion = random.choice(character_emotions[character][emotion])
+      rng = self._rng(comment.body, str(character), emotion)
+      character_emotion = rng.choice(character_emotions[character][emotion])
 
       for idx, chunk in enumerate(joined_sentences):
         character_block.append(
@@ -233,124 +396,444 @@ class PhoenixEngine(object):
       formatted_scenes.append(formatted_scene)
     return formatted_scenes
 
+  def _load_nlp(self):
+    if self.nlp is None:
+      self.nlp = spacy.load(
+        self.sentence_model
+      )
+      # sentence boundaries come from the parser, the other components are not used
+      self.nlp.disable_pipes(*[name for name in self.nlp.pipe_names if name not in ('tok2vec', 'parser')])
+
+    return self.nlp
+
+  def _sentence_model_version(self):
+    # model packages are upgraded apart from spacy, their version is read from the package
+    # metadata, or from meta.json for a model folder, without loading the pipeline
+    version = spacy.util.get_package_version(self.sentence_model)
+
+    if version is None and os.path.isdir(self.sentence_model):
+      version = spacy.util.get_model_meta(self.sentence_model).get('version')
+
+    return version
+
+  def _split_sentences(self, texts: List[str]) -> List[List[str]]:
+    # sentences of every text, keyed by the exact text since whitespace is kept in sentences
+    keys = [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in texts]
+    namespace = f'sentences:{self.sentence_model}:{self._sentence_model_version()}:{spacy.__version__}'
+    sentences = {}
+
+    if self.sentence_store is not None:
+      sentences = self.sentence_store.get_many(namespace, keys)
+
+    missing = {}
+    for key, text in zip(keys, texts):
+      if key not in sentences:
+        missing.setdefault(key, text)
+
+    if len(missing) > 0:
+      docs = self._load_nlp().pipe(missing.values(), batch_size=64, n_process=self.sentence_processes)
+      new_sentences = {
+        key: [sent.string.strip() for sent in doc.sents]
+        for key, doc in zip(missing, docs)
+      }
+
+      if self.sentence_store is not None:
+        self.sentence_store.put_many(namespace, new_sentences)
+      sentences.update(new_sentences)
+
+    return [sentences[key] for key in keys]
+
   def _render_video(self, scene_configs):
     video_path = os.path.join(self.cache_folder, 'video.mp4')
+
+    if self.render_processes > 1 or self.scene_cache:
+      self._render_segments(scene_configs, video_path)
+    else:
+      # its progress bar already shows the writer stats
+      self._render_segment(scene_configs, video_path, progress=True)
+
+    animation_cache.clear()
+
+    return video_path
+
+  def _render_segments(self, scene_configs, video_path):
+    segments = [
+      scene_configs[idx:idx + self.scenes_per_segment]
+      for idx in range(0, len(scene_configs), self.scenes_per_segment)
+    ]
+
+    if self.scene_cache:
+      segment_folder = os.path.join(self.cache_folder, 'scenes')
+      asset_fingerprint = self._asset_fingerprint()
+      segment_paths = [
+        os.path.join(segment_folder, f'{self._segment_key(segment, asset_fingerprint)}.mp4')
+        for segment in segments
+      ]
+      segment_sfx = [self._load_segment_sfx(segment_path) for segment_path in segment_paths]
+      # entries used by this render are the most recently used ones
+      for segment_path, sfx in zip(segment_paths, segment_sfx):
+        if sfx is not None:
+          os.utime(segment_path)
+    else:
+      segment_folder = os.path.join(self.cache_folder, 'segments')
+      segment_paths = [
+        os.path.join(segment_folder, f'segment-{idx:05d}.mp4') for idx in range(len(segments))
+      ]
+      segment_sfx = [None] * len(segments)
+    os.makedirs(segment_folder, exist_ok=True)
+
+    # identical segments share one cache entry and are only rendered once
+    pending_paths = {}
+    for idx, sfx in enumerate(segment_sfx):
+      if sfx is None:
+        pending_paths.setdefault(segment_paths[idx], idx)
+    pending = list(pending_paths.values())
+    pbar = tqdm(desc='creating video', total=len(pending))
+    writer_stats = {}
+
+    def segment_done(idx, result):
+      sfx, stats = result
+      segment_sfx[idx] = sfx
+      self._save_segment_sfx(segment_paths[idx], sfx)
+      for name, value in stats.items():
+        writer_stats[name] = writer_stats.get(name, 0) + value
+      pbar.set_postfix(writer_stats)
+      pbar.update()
+
+    if self.render_processes > 1:
+      with ProcessPoolExecutor(max_workers=self.render_processes) as pool:
+        # results come back in segment order, which keeps the sound effect timeline in order
+        results = pool.map(
+          self._render_segment,
+          [segments[idx] for idx in pending],
+          [segment_paths[idx] for idx in pending]
+        )
+        for idx, result in zip(pending, results):
+          segment_done(idx, result)
+    else:
+      for idx in pending:
+        segment_done(idx, self._render_segment(segments[idx], segment_paths[idx]))
+    pbar.close()
+
+    self._concat_segments(segment_paths, video_path)
+
+    if self.scene_cache:
+      self._evict_segments(segment_folder, keep=set(segment_paths))
+
+  def _render_segment(self, scene_configs, video_path, progress=False, compositor=None):
+    compositor = compositor or self.frame_compositor
+    # the compositor counts over its lifetime, the segment reports its own share
+    compositor_stats = compositor.stats()
     sound_effects = []
     process = None
-    for scene_config in tqdm(scene_configs, desc='creating video', total=len(scene_configs)):
-      scene_animations, scene_sfx = self._process_scene(scene_config)
-      for animation in scene_animations:
-        for frame in animation.frames:
-          frame_array = np.array(frame)[:, :, :3]
+    writer = None
+    frame_count = 0
+    scenes = deque(self._process_scene(scene_config) for scene_config in scene_configs)
+    holds = []
+
+    if self.hold_frames:
+      # layer states are cheap to compute, no text is rasterized for them
+      holds = self._hold_frames([animation for scene_animations, _ in scenes for animation in scene_animations])
+
+    if compositor.pix_fmt == 'pal8' and not compositor.fits(
+      [animation for scene_animations, _ in scenes for animation in scene_animations]
+    ):
+      # decided before ffmpeg starts, a segment with frames of more than 256 colours is rgb
+      compositor = self._make_compositor('numpy')
+      compositor_stats = {}
+
+    pbar = tqdm(desc='creating video', total=len(scenes), disable=not progress)
+    try:
+      while len(scenes) > 0:
+        # a scene is released once its frames are queued, so its text rasters do not pile up
+        # over the segment
+        scene_animations, scene_sfx = scenes.popleft()
+        # animations compose their frames lazily, each frame is written and dropped before the next
+        for animation in scene_animations:
           if process is None:
-            height, width, channels = frame_array.shape
+            width, height = animation.size
             video_input = ffmpeg.input(
               'pipe:',
               format='rawvideo',
-              pix_fmt='rgb24',
+              pix_fmt=compositor.pix_fmt,
               s=f'{width}x{height}',
               r=self.fps
             )
-            process = (
-              ffmpeg.output(
-                video_input,
-                video_path,
-                pix_fmt='yuv420p',
-                vcodec=self.video_codec,
-                r=self.fps,
-                crf=self.video_crf
+
+            if len(holds) > 0:
+              video_input = video_input.setpts(self._hold_pts(holds))
+
+            if self.upscale_filter == 'xbr':
+              video_input = video_input.filter('xbr', n=int(self.scaling_factor))
+            elif self.upscale_filter is not None:
+              video_input = video_input.filter(
+                'scale',
+                int(self.scaling_factor * width),
+                int(self.scaling_factor * height),
+                flags=self.upscale_filter
               )
-                .overwrite_output()
-                .run_async(pipe_stdin=True)
-            )
-          process.stdin.write(
-            frame_array.astype(np.uint8).tobytes()
-          )
-      sound_effects.extend(scene_sfx)
-    process.stdin.close()
+
+            if len(holds) > 0:
+              # fills every hold with duplicates of its frame, x264 codes them as skipped blocks
+              video_input = video_input.filter('fps', fps=self.fps)
+
+            stream = ffmpeg.output(
+              video_input,
+              video_path,
+              pix_fmt='yuv420p',
+              vcodec=self.video_codec,
+              r=self.fps,
+              crf=self.video_crf
+            ).overwrite_output()
+
+            if not progress:
+              # several workers encode at once, keep their output to errors
+              stream = stream.global_args('-loglevel', 'error')
+
+            process = stream.run_async(pipe_stdin=True)
+            # composing and writing to the ffmpeg pipe overlap through the writer thread
+            writer = FrameWriter(process.stdin, max_frames=self.writer_queue_frames)
+          for frame in compositor.frames(animation):
+            writer.write(frame)
+            frame_count += 1
+        sound_effects.extend(scene_sfx)
+        pbar.set_postfix(
+          fps=frame_count / max(pbar.format_dict['elapsed'], 1e-6),
+          producer_stalls=writer.producer_stalls,
+          consumer_stalls=writer.consumer_stalls
+        )
+        pbar.update()
+    except PaletteOverflow:
+      # a frame the check did not cover has more than 256 colours, the segment is rendered
+      # again as rgb
+      pbar.close()
+      if process is not None:
+        process.kill()
+        try:
+          writer.close()
+        except OSError:
+          pass
+        process.wait()
+      fallback = self._make_compositor('numpy')
+      return self._render_segment(scene_configs, video_path, progress=progress, compositor=fallback)
+
+    pbar.close()
+    writer.close()
     process.wait()
 
-    animation_cache.clear()
+    stats = writer.stats()
+    stats['held_frames'] = sum(length - 1 for _, length in holds)
+    for name, value in compositor.stats().items():
+      stats[name] = value - compositor_stats.get(name, 0)
+    return sound_effects, stats
+
+  def _hold_frames(self, animations: List[SceneAnimation]):
+    # consecutive frames with equal layer states are identical, so only the first frame of a
+    # run is composed and written and the rest are marked as held. Returns [written frame,
+    # run length] for every run. The last frame is always written, it ends the final hold.
+    holds = []
+    total = sum(len(animation) for animation in animations)
+    frame_count = 0
+    written = 0
+    previous = None
+    for animation in animations:
+      for offset, state in enumerate(animation.states()):
+        frame_count += 1
+
+        if state is not None and state == previous and frame_count < total:
+          if len(holds) > 0 and holds[-1][0] == written - 1:
+            holds[-1][1] += 1
+            animation.held.add(offset)
+            continue
+
+          if len(holds) < self.max_held_runs:
+            holds.append([written - 1, 2])
+            animation.held.add(offset)
+            continue
+
+        written += 1
+        previous = state
+
+    return holds
+
+  def _hold_pts(self, holds):
+    # the N-th written frame is shown after all frames before it, including the extra frames
+    # of the holds before it, timestamps are in frames of the input rate
+    delays = ''.join(f'+{length - 1}*gt(N,{frame})' for frame, length in holds)
+    return f'(N{delays})/(FRAME_RATE*TB)'
+
+  def _make_compositor(self, compositor):
+    # one buffer per queued frame, one being written and one being composed
+    return compositors[compositor](
+      ring_size=self.writer_queue_frames + 2,
+      memo_bytes=int(self.frame_memo_mb * 1024 * 1024)
+    )
 
-    return sound_effects, video_path
+  def _rng(self, *parts):
+    # random.Random seeded from a stable hash, str hashes are salted per process
+    digest = hashlib.sha1(repr((self.seed,) + parts).encode('utf-8')).hexdigest()
+    return random.Random(int(digest, 16))
+
+  def _asset_fingerprint(self):
+    fingerprint = hashlib.sha1()
+    for root, dirs, files in os.walk(self.assets_folder):
+      dirs.sort()
+      for file in sorted(files):
+        stat = os.stat(os.path.join(root, file))
+        fingerprint.update(
+          repr((os.path.relpath(os.path.join(root, file), self.assets_folder), stat.st_mtime_ns, stat.st_size))
+            .encode('utf-8')
+        )
+    return fingerprint.hexdigest()
+
+  def _segment_key(self, scene_configs, asset_fingerprint):
+    render_settings = (
+      self.render_version,
+      self.assets_folder,
+      self.fps,
+      self.video_codec,
+      self.video_crf,
+      self.scaling_factor,
+      self.upscale_filter,
+      self.lag_frames,
+      self.default_animation_length,
+      self.seed,
+    )
+    key = json.dumps([scene_configs, render_settings, asset_fingerprint], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+  def _load_segment_sfx(self, segment_path):
+    # the sfx timeline is written after its segment finished encoding and marks a usable entry
+    sfx_path = os.path.splitext(segment_path)[0] + '.json'
+
+    if not os.path.exists(sfx_path) or not os.path.exists(segment_path):
+      return None
+
+    with open(sfx_path) as f:
+      return json.load(f)
+
+  def _save_segment_sfx(self, segment_path, sound_effects):
+    if not self.scene_cache:
+      return
+
+    sfx_path = os.path.splitext(segment_path)[0] + '.json'
+    with open(sfx_path, 'w') as f:
+      json.dump(sound_effects, f)
+
+  def _evict_segments(self, segment_folder, keep):
+    # removes least recently used entries until the cache fits in scene_cache_mb, the
+    # segments of the current render are kept
+    entries = []
+    for file in os.listdir(segment_folder):
+      if file.endswith('.mp4'):
+        stat = os.stat(os.path.join(segment_folder, file))
+        entries.append((stat.st_mtime, stat.st_size, os.path.join(segment_folder, file)))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, segment_path in sorted(entries):
+      if total_bytes <= self.scene_cache_mb * 1024 * 1024:
+        break
+
+      if segment_path in keep:
+        continue
+
+      # the sfx timeline goes first, an entry without it is never used
+      sfx_path = os.path.splitext(segment_path)[0] + '.json'
+      if os.path.exists(sfx_path):
+        os.remove(sfx_path)
+      os.remove(segment_path)
+      total_bytes -= size
+
+  def _concat_segments(self, segment_paths: List[str], video_path: str):
+    # segments share codec settings, so the concat demuxer joins them without re-encoding. The
+    # list is unique to this render, renders sharing the cache folder do not overwrite it
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', dir=self.cache_folder, delete=False) as f:
+      for segment_path in segment_paths:
+        f.write(f"file '{os.path.abspath(segment_path)}'\n")
+
+    try:
+      (
+        ffmpeg.input(f.name, format='concat', safe=0)
+          .output(video_path, c='copy')
+          .overwrite_output()
+          .run(quiet=True)
+      )
+    finally:
+      os.remove(f.name)
 
   def _render_audio(self, sound_effects: List[Dict]):
-    audio_se = AudioSegment.empty()
-    bip = AudioSegment.from_wav(
-      f"{self.assets_folder}/sfx general/sfx-blipmale.wav"
-    ) + AudioSegment.silent(duration=50)
-    blink = AudioSegment.from_wav(f"{self.assets_folder}/sfx general/sfx-blink.wav")
-    blink -= 10
-    badum = AudioSegment.from_wav(f"{self.assets_folder}/sfx general/sfx-fwashing.wav")
-    long_bip = bip * 100
-    long_bip -= 10
     spf = 1 / self.fps * 1000
-    pheonix_objection = AudioSegment.from_mp3(f"{self.assets_folder}/Phoenix - objection.mp3")
-    edgeworth_objection = AudioSegment.from_mp3(
-      f"{self.assets_folder}/Edgeworth - (English) objection.mp3"
-    )
-    default_objection = AudioSegment.from_mp3(f"{self.assets_folder}/Payne - Objection.mp3")
-
-    # loop through all sfx which are not music tracks and combine them into a single track
+    # every sfx covers a known number of frames, so the whole timeline is allocated once
+    total_length = sum(obj.get("length", 0) for obj in sound_effects)
+    timeline = AudioTimeline(total_length * spf)
+
+    def load(path, gain=0.0):
+      # repeated cues and sfx are decoded once per process, or once per machine with the store
+      return audio_cache.get_samples(path, timeline.frame_rate, timeline.channels, gain=gain)
+
+    blink = load(f"{self.assets_folder}/sfx general/sfx-blink.wav", gain=-10)
+    bip = load(f"{self.assets_folder}/sfx general/sfx-blipmale.wav", gain=-10)
+    bip = np.concatenate([bip, np.zeros((timeline.offset(50), timeline.channels), dtype=np.int16)])
+    long_bip = np.tile(bip, (100, 1))
+    badum = load(f"{self.assets_folder}/sfx general/sfx-fwashing.wav")
+    objections = {
+      "phoenix": load(f"{self.assets_folder}/Phoenix - objection.mp3"),
+      "edgeworth": load(f"{self.assets_folder}/Edgeworth - (English) objection.mp3"),
+    }
+    default_objection = load(f"{self.assets_folder}/Payne - Objection.mp3")
+    blink_duration = 1000 * len(blink) / timeline.frame_rate
+
+    # write all sfx which are not music tracks at the position of their first frame
+    position = 0
     for obj in tqdm(sound_effects, total=len(sound_effects), desc='creating sound effects'):
       obj_type = obj["_type"]
-      obj_length = 0
-
-      if 'length' in obj:
-        obj_length = obj["length"]
-
+      obj_length = obj.get("length", 0)
+      obj_position = position * spf
       obj_duration = int(obj_length * spf)
 
-      if obj_type == "silence":
-        audio_se += AudioSegment.silent(duration=obj_duration)
-      elif obj_type == "bip":
-        obj_duration -= len(blink)
-        audio_se += blink + long_bip[:obj_duration]
+      if obj_type == "bip":
+        timeline.add(blink, obj_position, obj_duration)
+        timeline.add(long_bip, obj_position + blink_duration, obj_duration - blink_duration)
       elif obj_type == "objection":
-        obj_character = obj["character"]
-
-        if obj_character == "phoenix":
-          audio_se += pheonix_objection[:obj_duration]
-        elif obj_character == "edgeworth":
-          audio_se += edgeworth_objection[:obj_duration]
-        else:
-          audio_se += default_objection[:obj_duration]
+        timeline.add(
+          objections.get(obj["character"], default_objection), obj_position, obj_duration
+        )
       elif obj_type == "shock":
-        audio_se += badum[:obj_duration]
+        timeline.add(badum, obj_position, obj_duration)
+
+      position += obj_length
 
     music_tracks = []
     len_counter = 0
-    # loop through all music tracks and determine their length based on sound effects between them
+    position = 0
+    # loop through all music tracks and determine their position and length based on sound effects
     for obj in sound_effects:
       if obj["_type"] == "bg":
         if len(music_tracks) > 0:
           music_tracks[-1]["length"] = len_counter
           len_counter = 0
-        music_tracks.append({"src": obj["src"]})
+        music_tracks.append({"src": obj["src"], "position": position})
       else:
         len_counter += obj["length"]
+        position += obj["length"]
 
     if len(music_tracks) > 0 and len_counter > 0:
       music_tracks[-1]["length"] = len_counter
 
-    music_se = AudioSegment.empty()
-    # create music track based on computed lengths and combine tracks together
+    # mix music tracks into the same timeline, sums are clipped once when converting to pcm
     for track in tqdm(music_tracks, total=len(music_tracks), desc='creating music'):
-      track_length = track["length"]
-      track_duration = int(track_length * spf)
-      music_se += AudioSegment.from_mp3(track["src"])[:track_duration]
+      track_duration = int(track.get("length", 0) * spf)
+      timeline.add(load(track["src"]), track["position"] * spf, track_duration)
 
-    final_se = audio_se.overlay(music_se)
-    audio_path = os.path.join(self.cache_folder, 'audio.mp3')
-    final_se.export(audio_path, format="mp3")
-    return audio_path
+    return timeline
 
   def _process_scene(self, scene):
     sound_effects = []
     scene_animations = []
+    rng = self._rng(json.dumps(scene, sort_keys=True, default=str))
     bg = animation_cache.get_anim_img(
       f'{self.assets_folder}/{location_map[scene["location"]]}',
-      scaling_factor=self.scaling_factor
+      scaling_factor=self.render_scaling_factor
     )
     arrow = animation_cache.get_anim_img(
       f"{self.assets_folder}/arrow.png",
@@ -359,12 +842,12 @@ class PhoenixEngine(object):
       w=15,
       h=15,
       key_x=5,
-      scaling_factor=self.scaling_factor
+      scaling_factor=self.render_scaling_factor
     )
     textbox = animation_cache.get_anim_img(
       f"{self.assets_folder}/textbox4.png",
-      w=bg.w // self.scaling_factor,
-      scaling_factor=self.scaling_factor
+      w=bg.w // self.render_scaling_factor,
+      scaling_factor=self.render_scaling_factor
     )
     name_text_font_size = 10
     name_text_x = 4
@@ -378,21 +861,34 @@ class PhoenixEngine(object):
     if scene["location"] == Location.COURTROOM_LEFT:
       bench = animation_cache.get_anim_img(
         f"{self.assets_folder}/logo-left.png",
-        scaling_factor=self.scaling_factor
+        scaling_factor=self.render_scaling_factor
       )
     elif scene["location"] == Location.COURTROOM_RIGHT:
       bench = animation_cache.get_anim_img(
         f"{self.assets_folder}/logo-right.png",
-        scaling_factor=self.scaling_factor
+        scaling_factor=self.render_scaling_factor
       )
     elif scene["location"] == Location.WITNESS_STAND:
       bench = animation_cache.get_anim_img(
         f"{self.assets_folder}/witness_stand.png",
-        w=bg.w // self.scaling_factor,
-        scaling_factor=self.scaling_factor
+        w=bg.w // self.render_scaling_factor,
+        scaling_factor=self.render_scaling_factor
       )
       bench.y = bg.h - bench.h
 
+    # layers which never change within a location are flattened once, bg below the character
+    # and bench + textbox above it, and only used while they are not shaking
+    plate_key = (scene["location"], self.render_scaling_factor, self.assets_folder)
+    bg_plate = animation_cache.get_plate(
+      ("bg",) + plate_key,
+      [bg]
+    )
+    front_plate = animation_cache.get_plate(
+      ("front",) + plate_key,
+      [bench, textbox] if bench is not None else [textbox],
+      size=(bg.w, bg.h)
+    )
+
     if "audio" in scene:
       sound_effects.append({"_type": "bg", "src": f'{self.assets_folder}/{scene["audio"]}.mp3'})
 
@@ -410,7 +906,7 @@ class PhoenixEngine(object):
           font_size=name_text_font_size,
           x=name_text_x,
           y=name_text_y,
-          scaling_factor=self.scaling_factor
+          scaling_factor=self.render_scaling_factor
         )
         default = "normal" if "emotion" not in obj else obj["emotion"]
         default_path = (
@@ -425,20 +921,20 @@ class PhoenixEngine(object):
         default_character = animation_cache.get_anim_img(
           default_path,
           half_speed=True,
-          scaling_factor=self.scaling_factor
+          scaling_factor=self.render_scaling_factor
         )
 
         if "(a)" in default_path:
           talking_character = animation_cache.get_anim_img(
             default_path.replace("(a)", "(b)"),
             half_speed=True,
-            scaling_factor=self.scaling_factor
+            scaling_factor=self.render_scaling_factor
           )
         else:
           talking_character = animation_cache.get_anim_img(
             default_path,
             half_speed=True,
-            scaling_factor=self.scaling_factor
+            scaling_factor=self.render_scaling_factor
           )
 
       if "emotion" in obj:
@@ -455,20 +951,20 @@ class PhoenixEngine(object):
         default_character = animation_cache.get_anim_img(
           default_path,
           half_speed=True,
-          scaling_factor=self.scaling_factor
+          scaling_factor=self.render_scaling_factor
         )
 
         if "(a)" in default_path:
           talking_character = animation_cache.get_anim_img(
             default_path.replace("(a)", "(b)"),
             half_speed=True,
-            scaling_factor=self.scaling_factor
+            scaling_factor=self.render_scaling_factor
           )
         else:
           talking_character = animation_cache.get_anim_img(
             default_path,
             half_speed=True,
-            scaling_factor=self.scaling_factor
+            scaling_factor=self.render_scaling_factor
           )
 
       if "action" in obj and (
@@ -486,7 +982,7 @@ class PhoenixEngine(object):
           y=text_box_y,
           typewriter_effect=True,
           colour=_colour,
-          scaling_factor=self.scaling_factor
+          scaling_factor=self.render_scaling_factor
         )
         num_frames = len(_text) + self.lag_frames
         _character_name = character_name
@@ -498,7 +994,7 @@ class PhoenixEngine(object):
             font_size=name_text_font_size,
             x=name_text_x,
             y=name_text_y,
-            scaling_factor=self.scaling_factor
+            scaling_factor=self.render_scaling_factor
           )
 
         if obj["action"] == Action.TEXT_SHAKE_EFFECT:
@@ -509,12 +1005,16 @@ class PhoenixEngine(object):
             bench.shake_effect = True
 
           textbox.shake_effect = True
+          stage = [bg, character, bench, textbox]
+        else:
+          stage = [bg_plate, character, front_plate]
 
         scene_animations.append(
           SceneAnimation(
-            [bg, character, bench, textbox, _character_name, text],
+            stage + [_character_name, text],
             length=len(_text) - 1,
-            start_frame=current_frame
+            start_frame=current_frame,
+            rng=rng
           )
         )
         sound_effects.append({"_type": "bip", "length": len(_text) - 1})
@@ -531,9 +1031,10 @@ class PhoenixEngine(object):
         character = default_character
         scene_animations.append(
           SceneAnimation(
-            [bg, character, bench, textbox, _character_name, text, arrow],
+            [bg_plate, character, front_plate, _character_name, text, arrow],
             length=self.lag_frames,
-            start_frame=len(_text) - 1
+            start_frame=len(_text) - 1,
+            rng=rng
           )
         )
         current_frame += num_frames
@@ -566,7 +1067,8 @@ class PhoenixEngine(object):
           SceneAnimation(
             scene_objs,
             length=self.lag_frames,
-            start_frame=current_frame
+            start_frame=current_frame,
+            rng=rng
           )
         )
         sound_effects.append({"_type": "shock", "length": self.lag_frames})
@@ -583,21 +1085,23 @@ class PhoenixEngine(object):
         effect_image = animation_cache.get_anim_img(
           f"{self.assets_folder}/objection.gif",
           shake_effect=True,
-          scaling_factor=self.scaling_factor
+          scaling_factor=self.render_scaling_factor
         )
         character = default_character
         scene_animations.append(
           SceneAnimation(
-            [bg, character, bench, effect_image],
+            [bg_plate, character, bench, effect_image],
             length=self.default_animation_length,
-            start_frame=current_frame
+            start_frame=current_frame,
+            rng=rng
           )
         )
         scene_animations.append(
           SceneAnimation(
-            [bg, character, bench],
+            [bg_plate, character, bench],
             length=self.default_animation_length,
-            start_frame=current_frame
+            start_frame=current_frame,
+            rng=rng
           )
         )
 
@@ -614,21 +1118,23 @@ class PhoenixEngine(object):
         effect_image = animation_cache.get_anim_img(
           f"{self.assets_folder}/holdit.gif",
           shake_effect=True,
-          scaling_factor=self.scaling_factor
+          scaling_factor=self.render_scaling_factor
         )
         character = default_character
         scene_animations.append(
           SceneAnimation(
-            [bg, character, bench, effect_image],
+            [bg_plate, character, bench, effect_image],
             length=self.default_animation_length,
-            start_frame=current_frame
+            start_frame=current_frame,
+            rng=rng
           )
         )
         scene_animations.append(
           SceneAnimation(
-            [bg, character, bench],
+            [bg_plate, character, bench],
             length=self.default_animation_length,
-            start_frame=current_frame
+            start_frame=current_frame,
+            rng=rng
           )
         )
         sound_effects.append(
@@ -651,9 +1157,10 @@ class PhoenixEngine(object):
 
         scene_animations.append(
           SceneAnimation(
-            [bg, character, bench],
+            [bg_plate, character, bench],
             length=_length,
-            start_frame=current_frame
+            start_frame=current_frame,
+            rng=rng
           )
         )
         character.repeat = True
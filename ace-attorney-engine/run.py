@@ -44,6 +44,13 @@ if __name__ == '__main__':
     emotion_model=Settings.EMOTION_MODEL,
     sentence_model=Settings.SENTENCE_MODEL,
     emotion_threshold=Settings.EMOTION_THRESHOLD,
+    emotion_method=Settings.EMOTION_METHOD,
+    emotion_backend=Settings.EMOTION_BACKEND,
+    emotion_cache=Settings.EMOTION_CACHE,
+    emotion_threads=Settings.EMOTION_THREADS,
+    emotion_interop_threads=Settings.EMOTION_INTEROP_THREADS,
+    sentence_cache=Settings.SENTENCE_CACHE,
+    sentence_processes=Settings.SENTENCE_PROCESSES,
     music_min_scene_duration=Settings.MUSIC_MIN_SCENE_DURATION,
     fps=Settings.FPS,
     video_codec=Settings.VIDEO_CODEC,
@@ -52,6 +59,19 @@ if __name__ == '__main__':
     lag_frames=Settings.LAG_FRAMES,
     default_animation_length=Settings.DEFAULT_ANIMATION_LENGTH,
     scaling_factor=Settings.SCALING_FACTOR,
+    upscale_filter=Settings.UPSCALE_FILTER,
+    compositor=Settings.COMPOSITOR,
+    writer_queue_frames=Settings.WRITER_QUEUE_FRAMES,
+    image_cache_mb=Settings.IMAGE_CACHE_MB,
+    frame_memo_mb=Settings.FRAME_MEMO_MB,
+    sprite_store=Settings.SPRITE_STORE,
+    audio_store=Settings.AUDIO_STORE,
+    render_processes=Settings.RENDER_PROCESSES,
+    scenes_per_segment=Settings.SCENES_PER_SEGMENT,
+    scene_cache=Settings.SCENE_CACHE,
+    scene_cache_mb=Settings.SCENE_CACHE_MB,
+    seed=Settings.SEED,
+    hold_frames=Settings.HOLD_FRAMES,
     assets_folder=Settings.ASSETS_FOLDER,
     cache_folder=Settings.CACHE_FOLDER,
   )
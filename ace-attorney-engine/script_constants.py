@@ -83,12 +83,16 @@ character_location_map = {
   Character.GROSSBERG: Location.WITNESS_STAND,
 }
 
-# sadness
-# joy
-# love
-# anger
-# fear
-# surprise
+# labels of the emotion model
+emotion_labels = [
+  'sadness',
+  'joy',
+  'love',
+  'anger',
+  'fear',
+  'surprise',
+]
+
 objection_emotions = {
   'anger'
 }
@@ -15,6 +15,13 @@ class Settings:
   EMOTION_MODEL             = os.getenv('EMOTION_MODEL') or 'mrm8488/t5-base-finetuned-emotion'
   SENTENCE_MODEL            = os.getenv('SENTENCE_MODEL') or 'en_core_web_sm'
   EMOTION_THRESHOLD         = float(os.getenv('EMOTION_THRESHOLD') or 0.5)
+  EMOTION_METHOD            = os.getenv('EMOTION_METHOD') or 'generate'
+  EMOTION_BACKEND           = os.getenv('EMOTION_BACKEND') or 'torch'
+  EMOTION_CACHE             = (os.getenv('EMOTION_CACHE') or 'true').lower() == 'true'
+  EMOTION_THREADS           = int(os.getenv('EMOTION_THREADS')) if os.getenv('EMOTION_THREADS') else None
+  EMOTION_INTEROP_THREADS   = int(os.getenv('EMOTION_INTEROP_THREADS')) if os.getenv('EMOTION_INTEROP_THREADS') else None
+  SENTENCE_CACHE            = (os.getenv('SENTENCE_CACHE') or 'true').lower() == 'true'
+  SENTENCE_PROCESSES        = int(os.getenv('SENTENCE_PROCESSES') or 1)
   MAX_COMMENT_LENGTH        = int(os.getenv('MAX_COMMENT_LENGTH') or 100_000)
   MUSIC_MIN_SCENE_DURATION  = int(os.getenv('MUSIC_MIN_SCENE_DURATION') or 4)
   THEME                     = os.getenv('THEME') or 'classic'
@@ -25,3 +32,16 @@ class Settings:
   LAG_FRAMES                = int(os.getenv('LAG_FRAMES') or 25)
   DEFAULT_ANIMATION_LENGTH  = int(os.getenv('DEFAULT_ANIMATION_LENGTH') or 11)
   SCALING_FACTOR            = float(os.getenv('SCALING_FACTOR') or 2.0)
+  UPSCALE_FILTER            = os.getenv('UPSCALE_FILTER') or None
+  COMPOSITOR                = os.getenv('COMPOSITOR') or 'pil'
+  WRITER_QUEUE_FRAMES       = int(os.getenv('WRITER_QUEUE_FRAMES') or 32)
+  IMAGE_CACHE_MB            = int(os.getenv('IMAGE_CACHE_MB') or 1024)
+  FRAME_MEMO_MB             = int(os.getenv('FRAME_MEMO_MB') or 256)
+  SPRITE_STORE              = (os.getenv('SPRITE_STORE') or 'true').lower() == 'true'
+  AUDIO_STORE               = (os.getenv('AUDIO_STORE') or 'true').lower() == 'true'
+  RENDER_PROCESSES          = int(os.getenv('RENDER_PROCESSES') or 1)
+  SCENES_PER_SEGMENT        = int(os.getenv('SCENES_PER_SEGMENT')) if os.getenv('SCENES_PER_SEGMENT') else None
+  SCENE_CACHE               = (os.getenv('SCENE_CACHE') or 'false').lower() == 'true'
+  SCENE_CACHE_MB            = int(os.getenv('SCENE_CACHE_MB') or 2048)
+  SEED                      = int(os.getenv('SEED') or 0)
+  HOLD_FRAMES               = (os.getenv('HOLD_FRAMES') or 'true').lower() == 'true'
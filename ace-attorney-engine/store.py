@@ -0,0 +1,116 @@
+import os
+import json
+import sqlite3
+import hashlib
+from typing import List
+
+import numpy as np
+
+
+class ArrayStore(object):
+  # lists of numpy arrays persisted under a folder, one flat .npy per key so entries can be
+  # memory-mapped and their pages shared between processes, with a .json index of the shapes
+  def __init__(self, folder):
+    self.folder = folder
+
+  def key(self, *parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+  def file_key(self, path, *parts):
+    # entries are invalidated whenever the source file is modified
+    stat = os.stat(path)
+    return self.key(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, *parts)
+
+  def get(self, key) -> List[np.ndarray]:
+    index_path = os.path.join(self.folder, f'{key}.json')
+    data_path = os.path.join(self.folder, f'{key}.npy')
+
+    if not os.path.exists(index_path):
+      return None
+
+    try:
+      with open(index_path) as f:
+        index = json.load(f)
+      data = np.load(data_path, mmap_mode='r')
+    except (OSError, ValueError):
+      return None
+
+    arrays = []
+    offset = 0
+    for shape in index['shapes']:
+      size = int(np.prod(shape))
+      arrays.append(data[offset:offset + size].reshape(shape))
+      offset += size
+
+    return arrays
+
+  def put(self, key, arrays: List[np.ndarray]):
+    os.makedirs(self.folder, exist_ok=True)
+    index = {
+      'dtype': str(arrays[0].dtype),
+      'shapes': [list(arr.shape) for arr in arrays],
+    }
+    data = np.concatenate([np.ascontiguousarray(arr).reshape(-1) for arr in arrays])
+    # written to temporary files and moved into place, the index last, so concurrent
+    # renders never read a partial entry
+    suffix = f'.{os.getpid()}.tmp'
+    data_path = os.path.join(self.folder, f'{key}.npy')
+    index_path = os.path.join(self.folder, f'{key}.json')
+
+    with open(data_path + suffix, 'wb') as f:
+      np.save(f, data)
+    os.replace(data_path + suffix, data_path)
+
+    with open(index_path + suffix, 'w') as f:
+      json.dump(index, f)
+    os.replace(index_path + suffix, index_path)
+
+
+class KeyValueStore(object):
+  # json values by namespace and key in one sqlite file under the cache folder, shared by
+  # concurrent renders and kept across runs
+  def __init__(self, path):
+    self.path = path
+    self._connection = None
+
+  def __getstate__(self):
+    # connections stay with the process that opened them
+    state = self.__dict__.copy()
+    state['_connection'] = None
+    return state
+
+  def _connect(self):
+    if self._connection is None:
+      os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+      self._connection = sqlite3.connect(self.path, timeout=60)
+      self._connection.execute(
+        'CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))'
+      )
+      self._connection.commit()
+
+    return self._connection
+
+  def get_many(self, namespace, keys) -> dict:
+    connection = self._connect()
+    keys = list(dict.fromkeys(keys))
+    values = {}
+
+    # in chunks below sqlite's limit on query parameters
+    for idx in range(0, len(keys), 500):
+      chunk = keys[idx:idx + 500]
+      rows = connection.execute(
+        f'SELECT key, value FROM entries WHERE namespace = ? AND key IN ({",".join("?" * len(chunk))})',
+        [namespace] + chunk
+      )
+      for key, value in rows:
+        values[key] = json.loads(value)
+
+    return values
+
+  def put_many(self, namespace, values: dict):
+    connection = self._connect()
+    with connection:
+      connection.executemany(
+        'INSERT OR REPLACE INTO entries (namespace, key, value) VALUES (?, ?, ?)',
+        [(namespace, key, json.dumps(value)) for key, value in values.items()]
+      )
@@ -0,0 +1,68 @@
+import queue
+import threading
+
+
+class FrameWriter(object):
+  # writes frames to a stream (the ffmpeg stdin pipe) from a dedicated thread, so composing the
+  # next frames overlaps with ffmpeg consuming the previous ones
+  def __init__(self, stream, max_frames: int = 32):
+    # a queue of size 0 is unbounded, which would let ring buffered frames be overwritten
+    if max_frames < 1:
+      raise ValueError(f'max_frames must be at least 1, not {max_frames}')
+    self.stream = stream
+    self.max_frames = max_frames
+    self._queue = queue.Queue(maxsize=max_frames)
+    self._error = None
+    # how often the composer waited on a full queue, and the writer on an empty one
+    self.producer_stalls = 0
+    self.consumer_stalls = 0
+    self.frames_written = 0
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def write(self, frame):
+    if self._error is not None:
+      raise self._error
+
+    try:
+      self._queue.put_nowait(frame)
+    except queue.Full:
+      self.producer_stalls += 1
+      self._queue.put(frame)
+
+  def close(self):
+    self._queue.put(None)
+    self._thread.join()
+    self.stream.close()
+
+    if self._error is not None:
+      raise self._error
+
+  def stats(self):
+    return {
+      'frames': self.frames_written,
+      'producer_stalls': self.producer_stalls,
+      'consumer_stalls': self.consumer_stalls,
+    }
+
+  def _run(self):
+    while True:
+      try:
+        frame = self._queue.get_nowait()
+      except queue.Empty:
+        self.consumer_stalls += 1
+        frame = self._queue.get()
+
+      if frame is None:
+        break
+
+      if self._error is not None:
+        # keep draining so the composer never blocks on a writer that gave up
+        continue
+
+      try:
+        # buffers such as numpy frames are written in place, not copied to bytes first
+        self.stream.write(memoryview(frame))
+        self.frames_written += 1
+      except Exception as e:
+        self._error = e